@@ -0,0 +1,39 @@
+import os
+import queue
+import random
+import threading
+from uuid import uuid4
+from datetime import datetime
+
+
+class ImageArchiver:
+    '''
+    Writes a random `sample_rate` fraction of scored images to `data_dir` on a background thread.
+    Images are dropped rather than queued once `max_pending` writes are outstanding, so archiving can
+    never slow down or grow the memory of the request path.
+    '''
+
+    def __init__(self, data_dir, sample_rate=0.01, max_pending=256):
+        self.data_dir = data_dir
+        self.sample_rate = sample_rate
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        os.makedirs(data_dir, exist_ok=True)
+        self.worker = threading.Thread(target=self._run, name='image-archiver', daemon=True)
+        self.worker.start()
+
+    def submit(self, image_bytes):
+        if random.random() >= self.sample_rate:
+            return
+        try:
+            self.pending.put_nowait(image_bytes)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            image_bytes = self.pending.get()
+            # Saving image with unique file identifier
+            event_id = datetime.now().strftime('%Y-%m-%d-%H-%M-%S-') + str(uuid4())
+            with open(os.path.join(self.data_dir, f'{event_id}.png'), 'wb') as f:
+                f.write(image_bytes)
@@ -0,0 +1,138 @@
+'''
+CPU inference backends for the mmf hateful memes models. Every backend is a callable taking a SampleList
+and returning the (batch, 2) logits, so HatefulMemesInference can switch between them by config.
+
+eager                  the mmf model as loaded, fp32
+quantized              dynamic int8 quantization of every nn.Linear (BERT and the fusion layers)
+torchscript            traced TorchScript graph of the fp32 model
+quantized_torchscript  traced TorchScript graph of the quantized model
+onnx                   ONNX export run with onnxruntime
+onnx_int8              ONNX export with onnxruntime dynamic int8 quantization
+'''
+import os
+import threading
+
+import torch
+from torch import nn
+from mmf.common.sample import SampleList
+
+BACKENDS = ['eager', 'quantized', 'torchscript', 'quantized_torchscript', 'onnx', 'onnx_int8']
+TENSOR_INPUTS = ['image', 'input_ids', 'input_mask', 'segment_ids']
+
+
+def quantize(model):
+    # In place, so the fp32 weights are freed rather than kept alive by the caller's reference
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+class ScoresOnly(nn.Module):
+    '''
+    Tensor-in, tensor-out view of an mmf model, which is what tracing and ONNX export need.
+    '''
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image, input_ids, input_mask, segment_ids):
+        sample_list = SampleList()
+        sample_list.add_field('image', image)
+        sample_list.add_field('input_ids', input_ids)
+        sample_list.add_field('input_mask', input_mask)
+        sample_list.add_field('segment_ids', segment_ids)
+        sample_list.add_field('dataset_name', 'hateful_memes')
+        sample_list.add_field('dataset_type', 'test')
+        return self.model(sample_list)['scores']
+
+
+def tensor_inputs(sample_list):
+    return tuple(sample_list[name] for name in TENSOR_INPUTS)
+
+
+class EagerBackend:
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, sample_list):
+        return self.model(sample_list)['scores']
+
+
+class TorchScriptBackend:
+    def __init__(self, model, example, path=None):
+        if path and os.path.exists(path):
+            self.module = torch.jit.load(path)
+        else:
+            with torch.no_grad():
+                self.module = torch.jit.trace(ScoresOnly(model).eval(), tensor_inputs(example),
+                                              strict=False, check_trace=False)
+            self.module = torch.jit.freeze(self.module)
+            if path:
+                torch.jit.save(self.module, path)
+
+    def __call__(self, sample_list):
+        return self.module(*tensor_inputs(sample_list))
+
+
+class OnnxBackend:
+    '''
+    The onnxruntime session is created on the first call rather than here, so a model built in the worker
+    pool's zygote gets its session, and its threads, in each worker after the fork. It uses `num_threads`
+    intra-op threads, or as many as torch is set to use in that process.
+    '''
+    def __init__(self, model, example, path, int8=False, num_threads=None):
+        # Imported here all the same, so a missing onnxruntime fails when the model is built
+        import onnxruntime  # noqa: F401
+        self.path = path
+        self.num_threads = num_threads
+        self.session = None
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            export_path = path + '.fp32' if int8 else path
+            torch.onnx.export(
+                ScoresOnly(model).eval(), tensor_inputs(example), export_path,
+                input_names=TENSOR_INPUTS, output_names=['scores'], opset_version=14,
+                dynamic_axes={
+                    'image': {0: 'batch'},
+                    'input_ids': {0: 'batch', 1: 'sequence'},
+                    'input_mask': {0: 'batch', 1: 'sequence'},
+                    'segment_ids': {0: 'batch', 1: 'sequence'},
+                    'scores': {0: 'batch'},
+                })
+            if int8:
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                quantize_dynamic(export_path, path, weight_type=QuantType.QInt8)
+                os.remove(export_path)
+
+    def _session(self):
+        with self.lock:
+            if self.session is None:
+                import onnxruntime
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = self.num_threads or torch.get_num_threads()
+                self.session = onnxruntime.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+            return self.session
+
+    def __call__(self, sample_list):
+        feeds = {name: tensor.numpy() for name, tensor in zip(TENSOR_INPUTS, tensor_inputs(sample_list))}
+        return torch.from_numpy(self._session().run(['scores'], feeds)[0])
+
+
+def load_backend(model, backend, example, export_dir, model_type):
+    '''
+    Wraps `model` in the requested backend. Traced and exported graphs are cached in `export_dir`, keyed
+    by model type and backend, so the export cost is only paid once.
+    '''
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, expected one of {BACKENDS}')
+    if backend == 'eager':
+        return EagerBackend(model)
+    if backend == 'quantized':
+        return EagerBackend(quantize(model))
+
+    os.makedirs(export_dir, exist_ok=True)
+    if backend == 'torchscript':
+        return TorchScriptBackend(model, example, os.path.join(export_dir, f'{model_type}.pt'))
+    if backend == 'quantized_torchscript':
+        return TorchScriptBackend(quantize(model), example, os.path.join(export_dir, f'{model_type}.int8.pt'))
+    if backend == 'onnx':
+        return OnnxBackend(model, example, os.path.join(export_dir, f'{model_type}.onnx'))
+    return OnnxBackend(model, example, os.path.join(export_dir, f'{model_type}.int8.onnx'), int8=True)
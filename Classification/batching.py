@@ -0,0 +1,81 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+from mmf.common.sample import SampleList
+
+# Token tensors produced by the BERT processor and the value used to pad each of them
+PADDED_FIELDS = {'input_ids': 0, 'input_mask': 0, 'segment_ids': 0, 'lm_label_ids': -1}
+
+
+def collate(samples):
+    '''
+    Stacks samples into a SampleList, right-padding the BERT token tensors to the longest one in the batch.
+    '''
+    for field, pad_value in PADDED_FIELDS.items():
+        tensors = [sample[field] for sample in samples if field in sample]
+        if len(tensors) != len(samples):
+            continue
+        max_len = max(t.size(0) for t in tensors)
+        for sample in samples:
+            t = sample[field]
+            if t.size(0) < max_len:
+                padding = t.new_full((max_len - t.size(0),) + tuple(t.shape[1:]), pad_value)
+                sample[field] = torch.cat([t, padding], dim=0)
+    return SampleList(samples)
+
+
+class MicroBatcher:
+    '''
+    Collects samples submitted from any thread and runs them through `forward_fn` together, as soon as
+    `max_batch_size` samples are waiting or the oldest has waited `max_wait_ms`. Each caller gets a
+    Future resolving to its own probability.
+    '''
+
+    def __init__(self, forward_fn, max_batch_size=8, max_wait_ms=20):
+        self.forward_fn = forward_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.batches_run = 0
+        self.samples_run = 0
+        self.worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, sample):
+        future = Future()
+        self.requests.put((sample, future))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            samples = [sample for sample, _ in batch]
+            try:
+                probs = self.forward_fn(samples)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches_run += 1
+            self.samples_run += len(batch)
+            for (_, future), prob in zip(batch, probs):
+                future.set_result(prob)
+
+    def mean_batch_size(self):
+        return self.samples_run / self.batches_run if self.batches_run else 0.0
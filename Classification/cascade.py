@@ -0,0 +1,230 @@
+'''
+Cascaded scoring: cheap unimodal models run first and only memes they are unsure about reach the fusion
+model. Thresholds are calibrated on the dev split so the accuracy loss against the fusion model alone
+stays within a budget.
+
+    python cascade.py --calibrate --max-accuracy-loss 0.01
+'''
+import os
+import json
+import argparse
+import threading
+from collections import Counter
+
+from sklearn.metrics import accuracy_score
+
+try:
+    from .inference import HatefulMemesInference, score_or_none
+    from .metrics import REGISTRY
+except ImportError:
+    from inference import HatefulMemesInference, score_or_none
+    from metrics import REGISTRY
+
+DEFAULT_STAGES = ['unimodal_text', 'unimodal_image']
+THRESHOLDS_FILE = 'cascade_thresholds.json'
+
+EXITS = REGISTRY.counter('cascade_exits_total', 'Memes scored by the cascade, by the stage that answered')
+
+
+class CascadeScorer:
+    '''
+    Scores a meme with each stage in turn, returning the first probability that falls outside the stage's
+    (low, high) uncertainty band and falling through to the `final` model otherwise. The sample is built
+    once and shared by every stage, and several memes go through each stage as one batch.
+
+    Exposes the interface the bot and the server use (`infer_bytes`, `infer_batch`, `confirm`, batching and
+    the duplicate index), so it can stand in for HatefulMemesInference.
+    '''
+
+    def __init__(self, relative_dir, stages=DEFAULT_STAGES, final='late_fusion', thresholds=None, archive_rate=0.0,
+                 skip_textless_ocr=False):
+        self.stages = list(stages)
+        self.final = final
+        # Images are archived once, by the final model
+        self.models = {name: HatefulMemesInference(relative_dir, model_type=name,
+                                                   archive_rate=archive_rate if name == final else 0.0,
+                                                   skip_textless_ocr=skip_textless_ocr)
+                       for name in self.stages + [final]}
+        if thresholds is None:
+            with open(os.path.join(relative_dir, THRESHOLDS_FILE)) as f:
+                thresholds = json.load(f)
+        # A stage without thresholds never exits early
+        self.thresholds = {stage: tuple(thresholds.get(stage, (0.0, 1.0))) for stage in self.stages}
+        self.exits = Counter()
+        self.scored = 0
+        self.lock = threading.Lock()  # Memes are scored from several executor threads at once
+
+    def test(self, image_path, text):
+        return self._cascade([self.models[self.final]._build_sample(image_path, text)])[0]
+
+    def test_batch(self, image_paths, texts):
+        build = self.models[self.final]._build_sample
+        return self._cascade([build(image_path, text) for image_path, text in zip(image_paths, texts)])
+
+    def _cascade(self, samples):
+        # Each stage scores every sample still undecided in one forward pass
+        probs = [None] * len(samples)
+        undecided = list(range(len(samples)))
+        answered = Counter()
+        for stage in self.stages:
+            if not undecided:
+                break
+            low, high = self.thresholds[stage]
+            remaining = []
+            for i, prob in zip(undecided, self._forward(stage, [samples[i] for i in undecided])):
+                if prob <= low or prob >= high:
+                    probs[i] = prob
+                    answered[stage] += 1
+                else:
+                    remaining.append(i)
+            undecided = remaining
+        if undecided:
+            for i, prob in zip(undecided, self._forward(self.final, [samples[i] for i in undecided])):
+                probs[i] = prob
+            answered[self.final] += len(undecided)
+
+        with self.lock:
+            self.scored += len(samples)
+            self.exits.update(answered)
+        for stage, count in answered.items():
+            EXITS.inc(count, stage=stage)
+        return probs
+
+    def _forward(self, name, samples):
+        model = self.models[name]
+        # A lone sample goes through the stage's batcher, to share a forward pass with other requests
+        if len(samples) == 1 and model.batcher is not None:
+            return [model.batcher.submit(samples[0]).result()]
+        return model.forward(samples)
+
+    def infer_bytes(self, image_bytes, text):
+        return self.infer_batch([image_bytes], text)[0]
+
+    def infer_batch(self, images_bytes, text):
+        # Archiving, OCR and the near-duplicate index are the final model's; only the scoring is cascaded
+        final = self.models[self.final]
+        probs, pending = final._screen(images_bytes, text)
+        if len(pending) == 1:
+            results = [score_or_none(self.test, pending[0][1], pending[0][2])]
+        elif pending:
+            try:
+                results = self.test_batch([image for _, image, _, _ in pending], [text for _, _, text, _ in pending])
+            except OSError:
+                # A truncated image fails the whole batch, so the images are scored one by one to skip just it
+                results = [score_or_none(self.test, image, text) for _, image, text, _ in pending]
+        else:
+            results = []
+        final._record(probs, pending, results)
+        return probs
+
+    def enable_batching(self, max_batch_size=8, max_wait_ms=20):
+        # Each stage batches its own forward passes across concurrent requests
+        for model in self.models.values():
+            model.enable_batching(max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    def enable_duplicate_index(self, path, **kwargs):
+        self.models[self.final].enable_duplicate_index(path, **kwargs)
+
+    def save_duplicate_index(self):
+        self.models[self.final].save_duplicate_index()
+
+    def confirm(self, image_bytes):
+        self.models[self.final].confirm(image_bytes)
+
+    def warmup(self):
+        for model in self.models.values():
+            model.warmup()
+
+    def stats(self):
+        # Fraction of scored memes answered by each stage
+        with self.lock:
+            return {stage: self.exits[stage] / self.scored if self.scored else 0.0
+                    for stage in self.stages + [self.final]}
+
+
+def simulate(stage_probs, final_probs, thresholds, stages):
+    '''
+    Replays the cascade over precomputed probabilities, returning the cascade's probabilities and which
+    stage answered each meme.
+    '''
+    probs, answered = [], []
+    for i, final_prob in enumerate(final_probs):
+        for stage in stages:
+            low, high = thresholds.get(stage, (0.0, 1.0))
+            prob = stage_probs[stage][i]
+            if prob <= low or prob >= high:
+                probs.append(prob)
+                answered.append(stage)
+                break
+        else:
+            probs.append(final_prob)
+            answered.append('final')
+    return probs, answered
+
+
+def calibrate(stage_probs, final_probs, labels, stages, max_accuracy_loss, grid=20):
+    '''
+    Greedily picks each stage's (low, high) band, in cascade order, to maximise how many memes exit at that
+    stage while the cascade's accuracy stays within `max_accuracy_loss` of the final model alone.
+    '''
+    target = accuracy_score(labels, [p > 0.5 for p in final_probs]) - max_accuracy_loss
+    lows = [i / grid * 0.5 for i in range(grid + 1)]
+    highs = [0.5 + i / grid * 0.5 for i in range(grid + 1)]
+    thresholds = {}
+    for stage in stages:
+        best, best_exits = (0.0, 1.0), 0
+        for low in lows:
+            for high in highs:
+                candidate = dict(thresholds, **{stage: (low, high)})
+                probs, answered = simulate(stage_probs, final_probs, candidate, stages)
+                if accuracy_score(labels, [p > 0.5 for p in probs]) < target:
+                    continue
+                exits = answered.count(stage)
+                if exits > best_exits:
+                    best, best_exits = (low, high), exits
+        thresholds[stage] = best
+    return thresholds
+
+
+def report(name, stage_probs, final_probs, labels, thresholds, stages):
+    probs, answered = simulate(stage_probs, final_probs, thresholds, stages)
+    counts = Counter(answered)
+    print(f'{name}: cascade accuracy {accuracy_score(labels, [p > 0.5 for p in probs]):.3f}, '
+          f'final model accuracy {accuracy_score(labels, [p > 0.5 for p in final_probs]):.3f}')
+    for stage in stages + ['final']:
+        print(f'  answered by {stage}: {counts[stage] / len(labels):.1%}')
+
+
+if __name__ == '__main__':
+    from get_accuracy import DATA_DIR, DATA_FILES, load_subset, evaluate
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', nargs='+', default=DEFAULT_STAGES)
+    parser.add_argument('--final', default='late_fusion')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--max-accuracy-loss', type=float, default=0.01)
+    parser.add_argument('--calibrate', action='store_true', help=f'write calibrated thresholds to {THRESHOLDS_FILE}')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    splits = {'val': load_subset(DATA_FILES['val'], args.data_dir), 'test': load_subset(DATA_FILES['test'], args.data_dir)}
+    probs = {split: {} for split in splits}
+    for model_type in args.stages + [args.final]:
+        model = HatefulMemesInference(relative_dir='./', model_type=model_type)
+        for split, rows in splits.items():
+            probs[split][model_type] = evaluate(model, rows, args.data_dir, batch_size=args.batch_size, workers=args.workers)
+        del model
+
+    labels = {split: [row['label'] for row in rows] for split, rows in splits.items()}
+    if args.calibrate:
+        thresholds = calibrate(probs['val'], probs['val'][args.final], labels['val'], args.stages, args.max_accuracy_loss)
+        with open(THRESHOLDS_FILE, 'w') as f:
+            json.dump(thresholds, f, indent=2)
+        print(f'Calibrated thresholds: {thresholds}')
+    else:
+        with open(THRESHOLDS_FILE) as f:
+            thresholds = {stage: tuple(band) for stage, band in json.load(f).items()}
+
+    for split in splits:
+        report(split, probs[split], probs[split][args.final], labels[split], thresholds, args.stages)
@@ -0,0 +1,117 @@
+'''
+Accuracy parity, latency and memory of each CPU backend against the fp32 eager model.
+
+    python compare_backends.py --model-type late_fusion --backends quantized torchscript onnx_int8 \
+        --subsets val test --limit 500
+
+For every backend and subset it reports accuracy next to the fp32 accuracy, how often the hateful/not
+hateful decision agrees with fp32 and the largest probability difference. Latency is measured on
+preprocessed samples at batch size 1 and 8, and memory as the resident-set growth from loading the
+backend plus the size of its serialized weights.
+'''
+import io
+import os
+import gc
+import json
+import time
+import argparse
+import statistics
+
+import torch
+from sklearn.metrics import accuracy_score
+
+from get_accuracy import DATA_DIR, DATA_FILES, load_subset, evaluate
+from inference import HatefulMemesInference
+
+
+def rss_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def weights_bytes(model, backend_name):
+    backend = model.backend
+    if hasattr(backend, 'module'):
+        buffer = io.BytesIO()
+        torch.jit.save(backend.module, buffer)
+        return buffer.tell()
+    if hasattr(backend, 'session'):
+        export_dir = os.path.join('./', 'exported')
+        suffix = '.int8.onnx' if backend_name == 'onnx_int8' else '.onnx'
+        return os.path.getsize(os.path.join(export_dir, model.model_type + suffix))
+    buffer = io.BytesIO()
+    torch.save(backend.model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def latency(model, samples, batch_size, repeats=3):
+    timings = []
+    for _ in range(repeats):
+        for start in range(0, len(samples), batch_size):
+            batch = samples[start:start + batch_size]
+            begin = time.perf_counter()
+            model.forward(batch)
+            timings.append((time.perf_counter() - begin) * 1000 / len(batch))
+    return round(statistics.median(timings), 2)
+
+
+def run_backend(args, backend, data):
+    gc.collect()
+    rss_before = rss_bytes()
+    model = HatefulMemesInference(relative_dir='./', model_type=args.model_type, backend=backend)
+    result = {'rss_growth_mb': round((rss_bytes() - rss_before) / 2 ** 20, 1),
+              'weights_mb': round(weights_bytes(model, backend) / 2 ** 20, 1)}
+
+    first = data[next(iter(data))][:64]
+    samples = [model._build_sample(os.path.join(args.data_dir, row['img']), row['text']) for row in first]
+    model.forward(samples[:8])  # warm-up
+    result['ms_per_meme_batch_1'] = latency(model, samples, 1)
+    result['ms_per_meme_batch_8'] = latency(model, samples, 8)
+
+    probs = {}
+    for subset, rows in data.items():
+        probs[subset] = evaluate(model, rows, args.data_dir, batch_size=args.batch_size, workers=args.workers)
+    return result, probs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-type', default='late_fusion')
+    parser.add_argument('--backends', nargs='+', default=['quantized', 'torchscript', 'quantized_torchscript'])
+    parser.add_argument('--subsets', nargs='+', default=['val', 'test'])
+    parser.add_argument('--limit', type=int, help='only use the first N memes of each subset')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    data = {subset: load_subset(DATA_FILES[subset], args.data_dir)[:args.limit] for subset in args.subsets}
+
+    report = {}
+    baseline, baseline_probs = run_backend(args, 'eager', data)
+    report['eager'] = baseline
+    for subset, rows in data.items():
+        labels = [row['label'] for row in rows]
+        baseline[f'{subset}_accuracy'] = round(accuracy_score(labels, [p > 0.5 for p in baseline_probs[subset]]), 4)
+
+    for backend in args.backends:
+        result, probs = run_backend(args, backend, data)
+        for subset, rows in data.items():
+            labels = [row['label'] for row in rows]
+            reference = baseline_probs[subset]
+            result[f'{subset}_accuracy'] = round(accuracy_score(labels, [p > 0.5 for p in probs[subset]]), 4)
+            result[f'{subset}_accuracy_delta'] = round(result[f'{subset}_accuracy'] - baseline[f'{subset}_accuracy'], 4)
+            result[f'{subset}_decision_agreement'] = round(
+                sum((p > 0.5) == (r > 0.5) for p, r in zip(probs[subset], reference)) / len(rows), 4)
+            result[f'{subset}_max_prob_diff'] = round(max(abs(p - r) for p, r in zip(probs[subset], reference)), 4)
+        report[backend] = result
+
+    print(f'Model type: {args.model_type}')
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,13 +1,13 @@
 import os
 import json
+import time
+import argparse
 from tqdm import tqdm
 from sklearn.metrics import accuracy_score
+from torch.utils.data import Dataset, DataLoader
 
 from inference import HatefulMemesInference
 
-model_type = 'late_fusion'
-model = HatefulMemesInference(relative_dir='./', model_type=model_type)
-
 DATA_DIR = '/lfs/local/0/paridhi/MultimodalHateSpeech/HatefulMemesDataset'
 DATA_FILES = {
 	'train' : ['train.jsonl'],
@@ -15,27 +15,85 @@ DATA_FILES = {
 	'test' : ['test_seen.jsonl', 'test_unseen.jsonl']
 }
 
-for subset, files in DATA_FILES.items():
+
+def load_subset(files, data_dir=DATA_DIR):
 	data = []
 	for filename in files:
-		with open(os.path.join(DATA_DIR, filename), 'r') as json_file:
+		with open(os.path.join(data_dir, filename), 'r') as json_file:
 			json_list = list(json_file)
 		for json_str in json_list:
 			result = json.loads(json_str)
 			data.append(result)
+	return data
+
+
+class MemesDataset(Dataset):
+	'''
+	Decodes and tokenizes memes inside DataLoader workers so preprocessing overlaps with the forward pass.
+	'''
+	def __init__(self, model, data, data_dir=DATA_DIR):
+		self.model = model
+		self.data = data
+		self.data_dir = data_dir
+
+	def __len__(self):
+		return len(self.data)
+
+	def __getitem__(self, idx):
+		row = self.data[idx]
+		image_path = os.path.join(self.data_dir, row['img'])
+		return self.model._build_sample(image_path, row['text'])
+
+
+def evaluate(model, data, data_dir=DATA_DIR, batch_size=1, workers=0):
+	'''
+	Returns the hateful probability of every row in `data`. With batch_size 1 and no workers this is the
+	original one-meme-at-a-time loop; otherwise samples are prefetched by `workers` processes and scored
+	in batched forward passes.
+	'''
+	probs = []
+	if batch_size == 1 and workers == 0:
+		for row in tqdm(data):
+			image_path = os.path.join(data_dir, row['img'])
+			probs.append(model.test(image_path, row['text']))
+		return probs
+
+	prefetch = {'prefetch_factor': 4} if workers > 0 else {}
+	loader = DataLoader(MemesDataset(model, data, data_dir), batch_size=batch_size,
+						num_workers=workers, collate_fn=list, **prefetch)
+	for samples in tqdm(loader):
+		probs.extend(model.forward(samples))
+	return probs
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Accuracy of the hateful memes model on each dataset split')
+	parser.add_argument('--model-type', default='late_fusion')
+	parser.add_argument('--data-dir', default=DATA_DIR)
+	parser.add_argument('--batch-size', type=int, default=1)
+	parser.add_argument('--workers', type=int, default=0, help='DataLoader processes for image decoding and tokenization')
+	args = parser.parse_args()
+
+	model_type = args.model_type
+	model = HatefulMemesInference(relative_dir='./', model_type=model_type)
+
+	for subset, files in DATA_FILES.items():
+		data = load_subset(files, args.data_dir)
+
+		start = time.perf_counter()
+		probs = evaluate(model, data, args.data_dir, batch_size=args.batch_size, workers=args.workers)
+		elapsed = time.perf_counter() - start
+
+		label, pred = [], []
+		for row, prob in zip(data, probs):
+			label.append(row['label'])
+			pred.append(prob > 0.5)
+			row['pred'] = prob
+
+		accuracy = accuracy_score(label, pred)
+		print(f'Number of memes in {subset} subset: {len(data)}')
+		print(f'Accuracy on {subset} subset: {accuracy:.3f}')
+		print(f'Throughput on {subset} subset: {len(data) / elapsed:.1f} memes/sec')
 
-	label, pred = [], []
-	for row in tqdm(data):
-		image_path, text = row['img'], row['text']
-		image_path = os.path.join(DATA_DIR, image_path)
-		prob = model.test(image_path, text)
-		label.append(row['label'])
-		pred.append(prob > 0.5)
-		row['pred'] = prob
-
-	accuracy = accuracy_score(label, pred)
-	print(f'Number of memes in {subset} subset: {len(data)}')
-	print(f'Accuracy on {subset} subset: {accuracy:.3f}')
-
-	with open(f'{model_type}_{subset}_results.json', 'w') as f:
-		json.dump(data, f)
+		with open(f'{model_type}_{subset}_results.json', 'w') as f:
+			json.dump(data, f)
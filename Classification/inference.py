@@ -2,15 +2,13 @@
 ./miniserve HatefulMemesDataset/ --port 8081
 '''
 
+import io
 import os
+import hashlib
 import sys
 import torch
-import shutil
 import requests
-import pytesseract
 from PIL import Image
-from uuid import uuid4
-from datetime import datetime
 from omegaconf import OmegaConf
 import torch.nn.functional as F
 
@@ -19,15 +17,54 @@ from mmf.common.sample import Sample, SampleList
 from mmf.datasets.processors.bert_processors import BertTokenizer
 from mmf.datasets.processors.image_processors import TorchvisionTransforms
 
+try:
+    from .archive import ImageArchiver
+    from .backends import load_backend
+    from .batching import MicroBatcher, collate
+    from .metrics import timer
+    from .ocr import OCRPipeline
+    from .phash import BKTreeIndex, dhash
+    from .preprocess import FastPreprocessor
+except ImportError:
+    from archive import ImageArchiver
+    from backends import load_backend
+    from batching import MicroBatcher, collate
+    from metrics import timer
+    from ocr import OCRPipeline
+    from phash import BKTreeIndex, dhash
+    from preprocess import FastPreprocessor
+
+# Seconds to connect to, and then between bytes from, an image host, as for the bot's pooled client
+DOWNLOAD_TIMEOUT = 10
+
+
+def score_or_none(score, image, text):
+    # An image that turns out not to decode is left unscored (None) rather than failing the others with it
+    try:
+        return score(image, text)
+    except OSError as e:
+        print(f"Could not read image: {e!r}")
+        return None
+
 
 class HatefulMemesInference:
-    def __init__(self, relative_dir, model_type='late_fusion'):
+    def __init__(self, relative_dir, model_type='late_fusion', archive_rate=0.0, backend=None, fast_preprocess=False,
+                 skip_textless_ocr=False):
         self.model = None
+        self.model_type = model_type
+        self.backend = None
         self.text_processor = None
         self.image_processor = None
+        self.preprocessor = None
+        self.batcher = None
+        self.duplicates = None
+        self.ocr = OCRPipeline(skip_textless=skip_textless_ocr)
         self._get_model(model_type=model_type)
-        self._get_processers(relative_dir=relative_dir)
+        self._get_processers(relative_dir=relative_dir, fast_preprocess=fast_preprocess)
+        self._get_backend(relative_dir=relative_dir, model_type=model_type, backend=backend)
         self.data_dir = os.path.join(relative_dir, 'ServerRequests')
+        # Images are scored from memory; only a sampled fraction is archived to disk, off the request path
+        self.archiver = ImageArchiver(self.data_dir, sample_rate=archive_rate) if archive_rate > 0 else None
 
     def _get_model(self, model_type):
         if model_type == 'concat_bert':
@@ -44,49 +81,198 @@ class HatefulMemesInference:
             self.model = model_cls.from_pretrained("unimodal_image.hateful_memes.images")
         self.model.eval()
     
-    def _prepare_sample(self, image_path, text):
+    def _load_image(self, image):
+        # Accepts a file path, raw encoded bytes or an already decoded PIL image
+        if isinstance(image, Image.Image):
+            return image.convert("RGB")
+        if isinstance(image, (bytes, bytearray)):
+            return Image.open(io.BytesIO(image)).convert("RGB")
+        assert os.path.exists(image)
+        return Image.open(image).convert("RGB")
+
+    def _build_sample(self, image_path, text):
+        if self.preprocessor is not None:
+            return self.preprocessor.sample(image_path, text)
         sample = Sample()
-        assert os.path.exists(image_path)
-        image = Image.open(image_path).convert("RGB")
+        image = self._load_image(image_path)
         image_input = self.image_processor({"image": image})
         sample.image = image_input["image"]
         text_input = self.text_processor({"text" : text})
         sample.update(text_input)
-        return SampleList([sample])
+        return sample
+
+    def _prepare_sample(self, image_path, text):
+        return SampleList([self._build_sample(image_path, text)])
 
-    def _get_processers(self, relative_dir):
+    def _get_processers(self, relative_dir, fast_preprocess=False):
         text_processor_config = OmegaConf.load(os.path.join(relative_dir, "text_processor_config.yaml"))
-        self.text_processor = BertTokenizer(text_processor_config)
         image_processor_config = OmegaConf.load(os.path.join(relative_dir, "image_processor_config.yaml"))
+        if fast_preprocess:
+            self.preprocessor = FastPreprocessor(text_processor_config, image_processor_config)
+            return
+        self.text_processor = BertTokenizer(text_processor_config)
         self.image_processor = TorchvisionTransforms(image_processor_config)
 
+    def enable_batching(self, max_batch_size=8, max_wait_ms=20):
+        '''
+        Routes every call to `test` through a shared micro-batcher, so concurrent requests from different
+        threads share a single forward pass.
+        '''
+        self.batcher = MicroBatcher(self.forward, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    def enable_duplicate_index(self, path, radius=6, confirm_threshold=0.9, autosave_every=1000):
+        '''
+        Keeps a perceptual-hash index of every image scored by `infer_bytes`. Images within `radius` bits of
+        a confirmed hateful meme (model score above `confirm_threshold`, or confirmed by a moderator) reuse
+        its score without running the model.
+        '''
+        self.duplicates = BKTreeIndex.load(path)
+        self.duplicates_path = path
+        self.duplicate_radius = radius
+        self.confirm_threshold = confirm_threshold
+        self.autosave_every = autosave_every
+        self.unsaved_hashes = 0
+
+    def save_duplicate_index(self):
+        if self.duplicates is not None:
+            self.duplicates.save(self.duplicates_path)
+            self.unsaved_hashes = 0
+
+    def _index_image(self, image_hash, prob, confirmed=False):
+        self.duplicates.add(image_hash, prob, confirmed=confirmed or prob >= self.confirm_threshold)
+        self.unsaved_hashes += 1
+        if self.unsaved_hashes >= self.autosave_every:
+            self.save_duplicate_index()
+
+    def confirm(self, image_bytes):
+        # Marks an image as hateful after moderator review so its near-duplicates are caught directly
+        if self.duplicates is not None:
+            image = Image.open(io.BytesIO(image_bytes))
+            self._index_image(dhash(image), 1.0, confirmed=True)
+
+    def _get_backend(self, relative_dir, model_type, backend):
+        # The runtime comes from backend_config.yaml unless passed explicitly
+        if backend is None:
+            backend = OmegaConf.load(os.path.join(relative_dir, "backend_config.yaml")).backend
+        example = collate([self._build_sample(Image.new("RGB", (256, 256)), "warm up")])
+        export_dir = os.path.join(relative_dir, "exported")
+        self.backend = load_backend(self.model, backend, example, export_dir, model_type)
+
+    def forward(self, samples):
+        # Passing a batch of prepared samples to model
+        return self._predict(collate(samples))
+
+    def _predict(self, sample_list):
+        with timer('forward'), torch.no_grad():
+            probs = F.softmax(self.backend(sample_list), dim=1)[:, 1]
+        return probs.tolist()
+
     def test(self, image_path, text):
-        # Passing data to model
-        sample_list = self._prepare_sample(image_path, text)
-        with torch.no_grad():
-            prob = F.softmax(self.model(sample_list)["scores"], dim=1)[0, 1]
-        return prob.item()
+        with timer('preprocess'):
+            sample = self._build_sample(image_path, text)
+        if self.batcher is not None:
+            return self.batcher.submit(sample).result()
+        return self.forward([sample])[0]
+
+    def test_batch(self, image_paths, texts):
+        with timer('preprocess'):
+            if self.preprocessor is not None:
+                sample_list = self.preprocessor.batch(image_paths, texts)
+            else:
+                sample_list = collate([self._build_sample(image_path, text)
+                                       for image_path, text in zip(image_paths, texts)])
+        return self._predict(sample_list)
+
+    def warmup(self, batch_sizes=(1, 8)):
+        '''
+        Runs synthetic forward passes so lazy initialisation and allocator growth happen before the first
+        real request rather than during it.
+        '''
+        image = Image.new("RGB", (256, 256))
+        for batch_size in batch_sizes:
+            self.test_batch([image] * batch_size, ["warm up"] * batch_size)
+
+    def download(self, image_url):
+        r = requests.get(image_url, timeout=DOWNLOAD_TIMEOUT)
+        r.raise_for_status()
+        return r.content
 
     def infer(self, image_url, text):
-        # Downloading image with unique file identifier
-        event_id = datetime.now().strftime('%Y-%m-%d-%H-%M-%S-') + str(uuid4())
-        image_path = os.path.join(self.data_dir, f'{event_id}.png')
-        r = requests.get(image_url, stream=True)
-        if r.status_code == 200:
-            with open(image_path, 'wb') as f:
-                r.raw.decode_content = True
-                shutil.copyfileobj(r.raw, f)
-
-        # Running OCR to fetch text
-        if text is None:
-            text = pytesseract.image_to_string(image_path)
-            print("Inferring text using OCR")
-            print(f"Text: {text}")
-
-        # Passing data to model
-        prob = self.test(image_path, text)
-        print(f"Hateful Meme Score: {prob}")
-        return prob
+        return self.infer_bytes(self.download(image_url), text)
+
+    def infer_bytes(self, image_bytes, text):
+        return self.infer_batch([image_bytes], text)[0]
+
+    def infer_batch(self, images_bytes, text):
+        '''
+        Scores several images posted with the same text, such as the attachments of one message, in a single
+        forward pass. Returns one probability per image, or None for an image that could not be read.
+        '''
+        probs, pending = self._screen(images_bytes, text)
+        # Passing data to model; a lone image goes through `test` so the batcher can group it with other
+        # messages' images
+        if len(pending) == 1:
+            results = [score_or_none(self.test, pending[0][1], pending[0][2])]
+        elif pending:
+            try:
+                results = self.test_batch([image for _, image, _, _ in pending], [text for _, _, text, _ in pending])
+            except OSError:
+                # A truncated image fails the whole batch, so the images are scored one by one to skip just it
+                results = [score_or_none(self.test, image, text) for _, image, text, _ in pending]
+        else:
+            results = []
+        self._record(probs, pending, results)
+        return probs
+
+    def _screen(self, images_bytes, text):
+        '''
+        Archives the images, answers near-duplicates of confirmed hateful memes from the index and runs OCR
+        where there is no text. Returns the probabilities known so far (None for the rest) and a list of
+        (index, decoded image, text, image hash) for the images the model has to score. Images that are not
+        readable are left out of both.
+        '''
+        probs = [None] * len(images_bytes)
+        pending = []
+        for i, image_bytes in enumerate(images_bytes):
+            if self.archiver is not None:
+                self.archiver.submit(image_bytes)
+            try:
+                # Decoded lazily, so the fast preprocessor can still use a reduced-size JPEG decode when nothing
+                # below needs the full image
+                image = Image.open(io.BytesIO(image_bytes))
+
+                # Near-duplicates of confirmed hateful memes skip OCR and the model
+                image_hash = None
+                if self.duplicates is not None:
+                    image_hash = dhash(image)
+                    matches = self.duplicates.search(image_hash, self.duplicate_radius, confirmed_only=True)
+                    if matches:
+                        probs[i] = matches[0][2]
+                        print(f"Near-duplicate of a confirmed hateful meme, Hateful Meme Score: {probs[i]}")
+                        continue
+
+                # Running OCR to fetch text
+                image_text = text
+                if image_text is None:
+                    with timer('ocr'):
+                        image_text = self.ocr.image_to_string(image, hashlib.sha256(image_bytes).hexdigest())
+                    print("Inferring text using OCR")
+                    print(f"Text: {image_text}")
+            except OSError as e:
+                print(f"Could not read image {i}: {e!r}")
+                continue
+            pending.append((i, image, image_text, image_hash))
+        return probs, pending
+
+    def _record(self, probs, pending, results):
+        # Fills in the model's scores for the images `_screen` left pending and indexes their hashes
+        for (i, _, _, image_hash), prob in zip(pending, results):
+            if prob is None:
+                continue
+            probs[i] = prob
+            print(f"Hateful Meme Score: {prob}")
+            if image_hash is not None:
+                self._index_image(image_hash, prob)
 
 # if __name__ == "__main__":
 #     hm = HatefulMemesInference('./')
@@ -0,0 +1,52 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def timed(phase, timings):
+    # Records how long a startup phase took and reports it
+    start = time.perf_counter()
+    yield
+    timings[phase] = time.perf_counter() - start
+    print(f"Startup phase '{phase}' took {timings[phase]:.2f}s")
+
+
+class BackgroundModelLoader:
+    '''
+    Builds the model on a background thread and runs a warm-up forward pass before publishing it, so the
+    caller can start serving (text-only) right away. `factory` should do the heavy imports itself so that
+    importing this module stays cheap.
+    '''
+
+    def __init__(self, factory, on_ready=None, warmup=True):
+        self.factory = factory
+        self.on_ready = on_ready
+        self.warmup = warmup
+        self.model = None
+        self.error = None
+        self.ready = threading.Event()
+        self.timings = {}
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._load, name='model-loader', daemon=True)
+            self.thread.start()
+        return self
+
+    def _load(self):
+        try:
+            with timed('model load', self.timings):
+                model = self.factory()
+            if self.warmup:
+                with timed('model warm-up', self.timings):
+                    model.warmup()
+        except Exception as e:
+            self.error = e
+            print(f"Model failed to load: {e!r}")
+            return
+        self.model = model
+        self.ready.set()
+        if self.on_ready is not None:
+            self.on_ready(model)
@@ -0,0 +1,101 @@
+'''
+Load test for server.py: sends requests at increasing concurrency and reports latency percentiles and
+throughput for each level.
+
+    python loadtest.py --url http://localhost:8080 --image-url http://localhost:8081/img/01247.png \
+        --concurrency 1 2 4 8 16 32 --requests 200
+'''
+import time
+import json
+import base64
+import asyncio
+import argparse
+
+import aiohttp
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run_level(session, args, payload, endpoint, concurrency):
+    latencies, errors = [], 0
+    remaining = args.requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                async with session.post(endpoint, json=payload) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    memes = len(latencies) * args.batch_size
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50), 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 1) if latencies else None,
+        'memes_per_sec': round(memes / elapsed, 2),
+    }
+
+
+async def main(args):
+    item = {'text': args.text}
+    if args.image_file:
+        with open(args.image_file, 'rb') as f:
+            item['image_base64'] = base64.b64encode(f.read()).decode()
+    else:
+        item['image_url'] = args.image_url
+    if args.batch_size > 1:
+        payload, endpoint = {'items': [item] * args.batch_size}, args.url + '/infer/batch'
+    else:
+        payload, endpoint = item, args.url + '/infer'
+
+    timeout = aiohttp.ClientTimeout(total=120)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+        # Wait for the model to finish loading
+        while True:
+            try:
+                async with session.get(args.url + '/readyz') as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(1)
+
+        results = []
+        for concurrency in args.concurrency:
+            result = await run_level(session, args, payload, endpoint, concurrency)
+            print(f"concurrency {result['concurrency']:>4}: p50 {result['p50_ms']} ms, "
+                  f"p99 {result['p99_ms']} ms, {result['memes_per_sec']} memes/sec, {result['errors']} errors")
+            results.append(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--image-url', default='http://localhost:8081/img/01247.png')
+    parser.add_argument('--image-file', help='send the image inline instead of by URL')
+    parser.add_argument('--text', default="you can't be racist if there is no other race")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--requests', type=int, default=200, help='requests per concurrency level')
+    parser.add_argument('--batch-size', type=int, default=1, help='items per request, >1 uses /infer/batch')
+    parser.add_argument('--output', help='write results as JSON')
+    asyncio.run(main(parser.parse_args()))
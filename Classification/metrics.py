@@ -0,0 +1,177 @@
+'''
+Process-wide counters, histograms and gauges for the moderation pipeline, rendered in the Prometheus text
+format, plus per-stage timers that tag their log lines with the trace ID of the message being handled.
+
+    with timer('perspective'):
+        scores = await scheduler.analyze(text)
+
+Stage timings go to the `stage_seconds` histogram and, at DEBUG level, to the `moderation` logger.
+'''
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cache hit to a slow forward pass or a queued Perspective request
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger('moderation')
+
+# Trace ID of the message whose handling the current task or thread is part of
+TRACE_ID = contextvars.ContextVar('trace_id', default=None)
+
+
+def new_trace():
+    trace_id = uuid.uuid4().hex[:12]
+    TRACE_ID.set(trace_id)
+    return trace_id
+
+
+def in_context(fn, *args):
+    '''
+    Binds `fn` to a copy of the current context, so work handed to an executor keeps the trace ID.
+    '''
+    return functools.partial(contextvars.copy_context().run, fn, *args)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}  # Map from sorted label pairs to the count
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f'{self.name}{_label_text(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}  # Map from sorted label pairs to [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [0] * (len(self.buckets) + 2)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, entry in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_label_text(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{self.name}_bucket{_label_text(key + (("le", "+Inf"),))} {entry[-1]}')
+                lines.append(f'{self.name}_sum{_label_text(key)} {entry[-2]}')
+                lines.append(f'{self.name}_count{_label_text(key)} {entry[-1]}')
+        return lines
+
+
+class Gauge:
+    '''
+    A value read from `fn` whenever the metrics are rendered, such as a queue depth.
+    '''
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.fn()}']
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self._get_or_create(Counter, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, buckets)
+
+    def gauge(self, name, help, fn):
+        # Re-registering replaces the callback, e.g. when the bot restarts its components
+        with self.lock:
+            self.metrics[name] = Gauge(name, help, fn)
+            return self.metrics[name]
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram('stage_seconds', 'Time spent in each stage of the moderation pipeline')
+
+
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('trace=%s stage=%s ms=%.2f', TRACE_ID.get(), stage, elapsed * 1000)
+
+
+async def start_metrics_server(host='127.0.0.1', port=9108, registry=REGISTRY):
+    '''
+    Serves `registry` at http://host:port/metrics for Prometheus to scrape. Returns the aiohttp runner;
+    call its `cleanup()` to stop.
+    '''
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,118 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageFilter, ImageOps
+
+try:
+    # Bindings to the tesseract C API: the engine stays loaded between calls instead of spawning a process
+    import tesserocr
+except ImportError:
+    tesserocr = None
+import pytesseract
+
+
+def otsu_threshold(image):
+    histogram = image.histogram()
+    total = sum(histogram)
+    sum_all = sum(i * h for i, h in enumerate(histogram))
+    sum_background, weight_background = 0, 0
+    best, threshold = 0, 127
+    for i, h in enumerate(histogram):
+        weight_background += h
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += i * h
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        between = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if between > best:
+            best, threshold = between, i
+    return threshold
+
+
+class OCRPipeline:
+    '''
+    Text extraction for memes posted without a caption. Images are shrunk, converted to grayscale and
+    binarized before OCR, and results are cached by image hash. With `skip_textless`, images where a cheap
+    edge-density check finds no text-like structure skip OCR entirely; it is off by default because the check
+    can miss faint text. With tesserocr installed each calling thread keeps a persistent tesseract engine
+    (at most `workers` run at once); otherwise pytesseract is used.
+    '''
+
+    def __init__(self, workers=2, cache_size=10000, max_side=1280, binarize=True, skip_textless=False,
+                 min_edge_density=0.02):
+        self.max_side = max_side
+        self.binarize = binarize
+        self.skip_textless = skip_textless
+        self.min_edge_density = min_edge_density
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # Map from image hash to extracted text
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(workers)
+        self.engines = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def preprocess(self, image):
+        image = image.convert('L')
+        scale = self.max_side / max(image.size)
+        if scale < 1:
+            image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+        image = ImageOps.autocontrast(image)
+        if self.binarize:
+            threshold = otsu_threshold(image)
+            image = image.point(lambda p: 255 if p > threshold else 0)
+        return image
+
+    def has_text(self, image):
+        # Text is dense in sharp edges; flat photos and blank images are not
+        small = image.convert('L')
+        small.thumbnail((256, 256))
+        edges = small.filter(ImageFilter.FIND_EDGES)
+        histogram = edges.histogram()
+        strong = sum(histogram[64:])
+        return strong / max(1, sum(histogram)) >= self.min_edge_density
+
+    def _engine(self):
+        api = getattr(self.engines, 'api', None)
+        if api is None:
+            api = self.engines.api = tesserocr.PyTessBaseAPI()
+        return api
+
+    def _run(self, image):
+        with self.slots:
+            if tesserocr is not None:
+                api = self._engine()
+                api.SetImage(image)
+                return api.GetUTF8Text()
+            return pytesseract.image_to_string(image)
+
+    def image_to_string(self, image, digest=None):
+        if digest is None:
+            digest = hashlib.sha256(image.tobytes()).hexdigest()
+        with self.lock:
+            if digest in self.cache:
+                self.cache.move_to_end(digest)
+                self.hits += 1
+                return self.cache[digest]
+            self.misses += 1
+
+        if self.skip_textless and not self.has_text(image):
+            self.skipped += 1
+            text = ''
+        else:
+            text = self._run(self.preprocess(image)).strip()
+
+        with self.lock:
+            self.cache[digest] = text
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return text
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'skipped': self.skipped}
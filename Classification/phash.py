@@ -0,0 +1,106 @@
+import os
+import pickle
+import threading
+
+from PIL import Image
+
+
+def dhash(image, hash_size=8):
+    '''
+    64-bit difference hash: compares horizontally adjacent pixels of a shrunken grayscale image, so it is
+    stable under rescaling, recompression and small colour changes.
+    '''
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTreeIndex:
+    '''
+    BK-tree over image hashes with Hamming distance as the metric. A radius-r lookup only descends into
+    children whose edge distance lies within r of the query's distance to the node, so it visits a small
+    fraction of the tree. Nodes are kept in flat lists (no recursion) so huge trees pickle cleanly.
+    '''
+
+    def __init__(self):
+        self.hashes = []
+        self.scores = []
+        self.confirmed = []
+        self.children = []  # One dict per node, mapping edge distance to child node index
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, image_hash, score, confirmed=False):
+        with self.lock:
+            if not self.hashes:
+                self._append(image_hash, score, confirmed)
+                return
+            node = 0
+            while True:
+                distance = hamming(image_hash, self.hashes[node])
+                if distance == 0:
+                    # Same hash seen again: keep the latest score, never un-confirm
+                    self.scores[node] = score
+                    self.confirmed[node] = self.confirmed[node] or confirmed
+                    return
+                child = self.children[node].get(distance)
+                if child is None:
+                    self.children[node][distance] = self._append(image_hash, score, confirmed)
+                    return
+                node = child
+
+    def _append(self, image_hash, score, confirmed):
+        self.hashes.append(image_hash)
+        self.scores.append(score)
+        self.confirmed.append(confirmed)
+        self.children.append({})
+        return len(self.hashes) - 1
+
+    def search(self, image_hash, radius, confirmed_only=False):
+        '''
+        Returns (distance, hash, score) for every indexed hash within `radius`, closest first.
+        '''
+        matches = []
+        with self.lock:
+            if not self.hashes:
+                return matches
+            stack = [0]
+            while stack:
+                node = stack.pop()
+                distance = hamming(image_hash, self.hashes[node])
+                if distance <= radius and (self.confirmed[node] or not confirmed_only):
+                    matches.append((distance, self.hashes[node], self.scores[node]))
+                for edge, child in self.children[node].items():
+                    if distance - radius <= edge <= distance + radius:
+                        stack.append(child)
+        return sorted(matches)
+
+    def confirm(self, image_hash):
+        self.add(image_hash, 1.0, confirmed=True)
+
+    def save(self, path):
+        with self.lock:
+            state = (self.hashes, self.scores, self.confirmed, self.children)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                index.hashes, index.scores, index.confirmed, index.children = pickle.load(f)
+        return index
@@ -0,0 +1,112 @@
+import io
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+from mmf.common.sample import Sample, SampleList
+from transformers import BertTokenizerFast
+
+
+def _transform_params(image_config):
+    params = {}
+    for transform in image_config.transforms:
+        if isinstance(transform, str):
+            continue
+        params[transform.type] = transform.params
+    return params
+
+
+class FastPreprocessor:
+    '''
+    Vectorized replacement for mmf's BertTokenizer and TorchvisionTransforms processors, built from the same
+    text_processor_config.yaml and image_processor_config.yaml.
+
+    Text goes through the Rust-backed tokenizer in one call per batch and is padded to the longest text in
+    the batch rather than to max_seq_length. JPEGs are decoded at the smallest power-of-two scale that still
+    covers the Resize size (PIL draft mode), and Resize followed by CenterCrop is done as a single resize of
+    the matching source box. Normalization runs once over the whole batch, in place, in tensors that are
+    allocated once per thread and reused.
+    '''
+
+    def __init__(self, text_config, image_config):
+        self.tokenizer = BertTokenizerFast.from_pretrained(
+            text_config.tokenizer_config.type, **text_config.tokenizer_config.params)
+        self.max_seq_length = text_config.max_seq_length
+
+        params = _transform_params(image_config)
+        self.resize = tuple(params['Resize'].size)
+        self.crop = tuple(params['CenterCrop'].size)
+        mean = torch.tensor(list(params['Normalize'].mean)).view(3, 1, 1)
+        std = torch.tensor(list(params['Normalize'].std)).view(3, 1, 1)
+        # (x / 255 - mean) / std folded into a single multiply and subtract
+        self.scale = 1 / (255 * std)
+        self.shift = mean / std
+        self.buffers = threading.local()
+
+    def _open(self, image):
+        if isinstance(image, (bytes, bytearray)):
+            image = Image.open(io.BytesIO(image))
+        elif not isinstance(image, Image.Image):
+            image = Image.open(image)
+        # No-op unless the image is a JPEG that has not been decoded yet
+        image.draft('RGB', self.resize)
+        return image
+
+    def _resize_crop(self, image):
+        image = self._open(image)
+        width, height = image.size
+        # The part of the source image that survives Resize(resize) followed by CenterCrop(crop)
+        left = width * (self.resize[1] - self.crop[1]) / (2 * self.resize[1])
+        top = height * (self.resize[0] - self.crop[0]) / (2 * self.resize[0])
+        box = (left, top, width - left, height - top)
+        return image.convert('RGB').resize((self.crop[1], self.crop[0]), Image.BILINEAR, box=box)
+
+    def _buffers(self, batch_size):
+        pixels = getattr(self.buffers, 'pixels', None)
+        if pixels is None or pixels.size(0) < batch_size:
+            self.buffers.pixels = torch.empty((batch_size,) + self.crop + (3,), dtype=torch.uint8)
+            self.buffers.images = torch.empty((batch_size, 3) + self.crop)
+        return self.buffers.pixels[:batch_size], self.buffers.images[:batch_size]
+
+    def images(self, images, reuse=True):
+        '''
+        Returns a normalized (batch, 3, H, W) tensor. With `reuse` the tensor is a view of this thread's
+        buffer and is only valid until the thread's next call.
+        '''
+        if reuse:
+            pixels, out = self._buffers(len(images))
+        else:
+            pixels = torch.empty((len(images),) + self.crop + (3,), dtype=torch.uint8)
+            out = torch.empty((len(images), 3) + self.crop)
+        staging = pixels.numpy()
+        for i, image in enumerate(images):
+            staging[i] = np.asarray(self._resize_crop(image))
+        out.copy_(pixels.permute(0, 3, 1, 2))
+        return out.mul_(self.scale).sub_(self.shift)
+
+    def texts(self, texts):
+        encoded = self.tokenizer(list(texts), padding='longest', truncation=True, max_length=self.max_seq_length,
+                                 return_token_type_ids=True, return_attention_mask=True, return_tensors='pt')
+        input_ids = encoded['input_ids']
+        return {
+            'input_ids': input_ids,
+            'input_mask': encoded['attention_mask'],
+            'segment_ids': encoded['token_type_ids'],
+            'lm_label_ids': torch.full_like(input_ids, -1),
+        }
+
+    def sample(self, image, text):
+        # A standalone Sample (no shared buffers), for the micro-batcher
+        sample = Sample()
+        sample.image = self.images([image], reuse=False)[0]
+        for field, tensor in self.texts([text]).items():
+            sample[field] = tensor[0]
+        return sample
+
+    def batch(self, images, texts):
+        sample_list = SampleList()
+        sample_list.add_field('image', self.images(images))
+        for field, tensor in self.texts(texts).items():
+            sample_list.add_field(field, tensor)
+        return sample_list
@@ -0,0 +1,279 @@
+'''
+Async inference service for the hateful memes model, superseding the Flask dev servers in server1.py and
+server2.py (their URLs keep working).
+
+    python server.py --port 8080
+
+GET  /?text=<TEXT>&image=<IMAGE_URL>               same as server1 (without `image`, the upload page)
+GET  /infer?text=<TEXT>&image=<IMAGE_URL>          same as server1
+POST /infer   multipart: file=<IMAGE>, caption=<TEXT>  same as server2
+POST /infer   JSON: {"image_url": ..., "text": ...} or {"image_base64": ..., "text": ...}
+POST /infer/batch   JSON: {"items": [{"image_url": ..., "text": ...}, ...]}
+GET  /healthz   process is up
+GET  /readyz    model is loaded and warm, with the cascade's or worker pool's statistics
+GET  /metrics   per-stage latency histograms in the Prometheus text format
+
+A missing or empty text makes the model fall back to OCR. Bad requests and images that cannot be decoded
+get a 400, bodies and images over the size limits a 413, images that cannot be fetched and scoring
+failures a 502. All requests share one model whose micro-batcher merges concurrent requests into a single
+forward pass, or with --workers N a pool of N forked model processes. With --cascade, memes are scored by
+CascadeScorer (see cascade.py).
+'''
+import os
+import asyncio
+import json
+import base64
+import logging
+import argparse
+import functools
+import contextlib
+
+import aiohttp
+import uvicorn
+from PIL import UnidentifiedImageError
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from loader import BackgroundModelLoader
+from metrics import REGISTRY
+
+# Fraction of requests whose image is archived under ServerRequests/
+ARCHIVE_RATE = 0.05
+MAX_BATCH_ITEMS = 64
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+# Largest request body read, enough for one base64-encoded image of MAX_IMAGE_BYTES
+MAX_BODY_BYTES = 12 * 1024 * 1024
+
+logger = logging.getLogger('server')
+logger.addHandler(logging.FileHandler('server.log'))
+logger.setLevel(logging.INFO)
+
+
+# Number of forked model processes; 1 serves from a single in-process model
+WORKERS = 1
+# Score with CascadeScorer, which needs cascade_thresholds.json from `python cascade.py --calibrate`
+CASCADE = False
+
+
+def build_model():
+    if CASCADE:
+        from cascade import CascadeScorer as model_cls
+    else:
+        from inference import HatefulMemesInference as model_cls
+    if WORKERS > 1:
+        # The workers load the model in a process of their own, so this one only archives
+        from archive import ImageArchiver
+        from worker_pool import WorkerPool
+        return WorkerPool(functools.partial(model_cls, './'), num_workers=WORKERS,
+                          archiver=ImageArchiver(os.path.join('./', 'ServerRequests'), sample_rate=ARCHIVE_RATE))
+    model = model_cls('./', archive_rate=ARCHIVE_RATE)
+    model.enable_batching(max_batch_size=8, max_wait_ms=20)
+    return model
+
+
+loader = BackgroundModelLoader(build_model)
+http = None
+
+
+class BadRequest(Exception):
+    pass
+
+
+class TooLarge(BadRequest):
+    pass
+
+
+async def download(image_url):
+    async with http.get(image_url) as response:
+        if response.status != 200:
+            raise BadRequest(f'Could not download {image_url}: HTTP {response.status}')
+        image_bytes = await response.content.read(MAX_IMAGE_BYTES + 1)
+        if len(image_bytes) > MAX_IMAGE_BYTES:
+            raise TooLarge(f'{image_url} is larger than {MAX_IMAGE_BYTES} bytes')
+        return image_bytes
+
+
+async def image_from_item(item):
+    if not isinstance(item, dict):
+        raise BadRequest('Expected a JSON object')
+    if item.get('image_base64'):
+        # Four base64 characters per three bytes
+        if len(item['image_base64']) * 3 // 4 > MAX_IMAGE_BYTES:
+            raise TooLarge(f'The image is larger than {MAX_IMAGE_BYTES} bytes')
+        return base64.b64decode(item['image_base64'])
+    if item.get('image_url'):
+        return await download(item['image_url'])
+    raise BadRequest('Each item needs an image_url or image_base64')
+
+
+async def score(image_bytes, text):
+    prob = await run_in_threadpool(loader.model.infer_bytes, image_bytes, text or None)
+    if prob is None:
+        # The model leaves images it cannot decode unscored
+        raise UnidentifiedImageError('cannot identify image file')
+    logger.info(f'Text: {text!r} Probability of Hateful: {prob:.3f}')
+    return {'Hateful': prob}
+
+
+def not_ready():
+    return JSONResponse({'error': 'Model is still loading'}, status_code=503)
+
+
+async def read_json(request):
+    # Read a chunk at a time, so a body without a Content-Length is cut off at MAX_BODY_BYTES as well
+    if int(request.headers.get('content-length') or 0) > MAX_BODY_BYTES:
+        raise TooLarge(f'The request body is larger than {MAX_BODY_BYTES} bytes')
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > MAX_BODY_BYTES:
+            raise TooLarge(f'The request body is larger than {MAX_BODY_BYTES} bytes')
+    item = json.loads(body)
+    if not isinstance(item, dict):
+        raise BadRequest('Expected a JSON object')
+    return item
+
+
+async def read_request(request):
+    if request.method == 'GET':
+        return await download(request.query_params['image']), request.query_params.get('text')
+    if request.headers.get('content-type', '').startswith('multipart/form-data'):
+        # The upload is spooled to disk while the form is parsed; only its Content-Length bounds that
+        if not request.headers.get('content-length'):
+            raise BadRequest('Uploads need a Content-Length')
+        if int(request.headers['content-length']) > MAX_BODY_BYTES:
+            raise TooLarge(f'The request body is larger than {MAX_BODY_BYTES} bytes')
+        form = await request.form()
+        image_bytes = await form['file'].read(MAX_IMAGE_BYTES + 1)
+        if len(image_bytes) > MAX_IMAGE_BYTES:
+            raise TooLarge(f'The image is larger than {MAX_IMAGE_BYTES} bytes')
+        return image_bytes, form.get('caption', '')
+    item = await read_json(request)
+    return await image_from_item(item), item.get('text')
+
+
+def bad_request(e):
+    return JSONResponse({'error': str(e)}, status_code=413 if isinstance(e, TooLarge) else 400)
+
+
+def download_failed(e):
+    return JSONResponse({'error': f'Could not download the image: {type(e).__name__} {e}'.strip()}, status_code=502)
+
+
+def scoring_error(e):
+    # (status, message) for an exception raised while scoring
+    if isinstance(e, (UnidentifiedImageError, OSError)):
+        return 400, f'Could not read the image: {e}'
+    logger.error(f'Scoring failed: {e!r}')
+    return 502, 'Scoring failed'
+
+
+async def infer(request):
+    if not loader.ready.is_set():
+        return not_ready()
+    try:
+        image_bytes, text = await read_request(request)
+    except (BadRequest, KeyError, ValueError) as e:
+        return bad_request(e)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return download_failed(e)
+    try:
+        return JSONResponse(await score(image_bytes, text))
+    except Exception as e:
+        status, message = scoring_error(e)
+        return JSONResponse({'error': message}, status_code=status)
+
+
+async def infer_batch(request):
+    if not loader.ready.is_set():
+        return not_ready()
+    try:
+        items = (await read_json(request))['items']
+        if not isinstance(items, list):
+            raise BadRequest('items must be a list')
+        if len(items) > MAX_BATCH_ITEMS:
+            raise BadRequest(f'At most {MAX_BATCH_ITEMS} items per batch')
+        images = await asyncio.gather(*(image_from_item(item) for item in items))
+    except (BadRequest, KeyError, ValueError) as e:
+        return bad_request(e)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return download_failed(e)
+    # Submitted concurrently so the micro-batcher scores them in as few forward passes as possible; an item
+    # that fails gets an error in its place rather than failing the batch
+    results = await asyncio.gather(*(score(image, item.get('text')) for image, item in zip(images, items)),
+                                   return_exceptions=True)
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            status, message = scoring_error(result)
+            results[i] = {'error': message, 'status': status}
+    return JSONResponse({'results': results})
+
+
+async def healthz(request):
+    return JSONResponse({'status': 'ok'})
+
+
+async def readyz(request):
+    if loader.error is not None:
+        return JSONResponse({'status': 'failed', 'error': repr(loader.error)}, status_code=503)
+    if not loader.ready.is_set():
+        return not_ready()
+    body = {'status': 'ready', 'startup_timings': loader.timings}
+    # The cascade reports how often each stage answers, the worker pool its load and restarts
+    if hasattr(loader.model, 'stats'):
+        body['model_stats'] = loader.model.stats()
+    return JSONResponse(body)
+
+
+async def metrics(request):
+    return PlainTextResponse(REGISTRY.render())
+
+
+async def index(request):
+    # server1 scored GET /?text=..&image=..
+    if 'image' in request.query_params:
+        return await infer(request)
+    return FileResponse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html'))
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global http
+    http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10),
+                                 connector=aiohttp.TCPConnector(limit=100, limit_per_host=16))
+    loader.start()
+    yield
+    await http.close()
+    # Stops the worker pool's processes; a single in-process model has nothing to close
+    if hasattr(loader.model, 'close'):
+        await run_in_threadpool(loader.model.close)
+
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/infer', infer, methods=['GET', 'POST']),
+        Route('/infer/batch', infer_batch, methods=['POST']),
+        Route('/healthz', healthz),
+        Route('/readyz', readyz),
+        Route('/metrics', metrics),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hateful memes inference server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='model processes forked from a single loaded copy of the weights, shared copy-on-write')
+    parser.add_argument('--cascade', action='store_true',
+                        help='score with the unimodal models first, and the fusion model only when they are unsure')
+    args = parser.parse_args()
+    WORKERS = args.workers
+    CASCADE = args.cascade
+    # A single server process: the model (or worker pool) is shared by every request
+    uvicorn.run(app, host=args.host, port=args.port, log_level='info')
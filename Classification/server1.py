@@ -1,16 +1,22 @@
-import os
-import wget
 import logging
-import pytesseract
-from PIL import Image
-from uuid import uuid4
-from datetime import datetime
 from flask import Flask, request, jsonify
 
-from inference import HatefulMemesInference
-model = HatefulMemesInference()
+from loader import BackgroundModelLoader
 
-DATA_DIR = 'ServerRequests'
+# Fraction of requests whose image is archived under ServerRequests/
+ARCHIVE_RATE = 0.05
+
+
+def build_model():
+    from inference import HatefulMemesInference
+    model = HatefulMemesInference('./', archive_rate=ARCHIVE_RATE)
+    # Concurrent requests are served by Flask's worker threads and share forward passes
+    model.enable_batching(max_batch_size=8, max_wait_ms=20)
+    return model
+
+
+# The server starts accepting requests while the model loads and answers 503 until it is warm
+loader = BackgroundModelLoader(build_model).start()
 
 app = Flask(__name__)
 
@@ -36,19 +42,18 @@ print(output)
 
 @app.route('/')
 def infer():
+    if not loader.ready.is_set():
+        return jsonify({'error': 'Model is still loading'}), 503
+    model = loader.model
     text = request.args.get('text')
     image_url = request.args.get('image')
-    event_id = datetime.now().strftime('%Y-%m-%d-%H-%M-%S-') + str(uuid4())
-    image_path = os.path.join(DATA_DIR, f'{event_id}.png')
-    wget.download(image_url, image_path)
-    if text is None:
-        text = pytesseract.image_to_string(Image.open(image_path))
-    prob = model.infer(image_path, text)
+    # The image is decoded from memory; OCR runs inside infer_bytes when no text is given
+    image_bytes = model.download(image_url)
+    prob = model.infer_bytes(image_bytes, text)
     # Logging
     logger.info('-'*100)
     logger.info(f'Text: {text}')
     logger.info(f'Image URL: {image_url}')
-    logger.info(f'Image Path: {image_path}')
     logger.info(f'Probability of Hateful: {prob:.3f}')
     logger.info('-'*100)
     return jsonify({'Hateful': prob})
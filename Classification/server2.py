@@ -1,15 +1,22 @@
-import os
 import logging
-import pytesseract
-from PIL import Image
-from uuid import uuid4
-from datetime import datetime
 from flask import Flask, request, jsonify, render_template
 
-from inference import HatefulMemesInference
-model = HatefulMemesInference()
+from loader import BackgroundModelLoader
 
-DATA_DIR = 'ServerRequests'
+# Fraction of requests whose image is archived under ServerRequests/
+ARCHIVE_RATE = 0.05
+
+
+def build_model():
+    from inference import HatefulMemesInference
+    model = HatefulMemesInference('./', archive_rate=ARCHIVE_RATE)
+    # Concurrent requests are served by Flask's worker threads and share forward passes
+    model.enable_batching(max_batch_size=8, max_wait_ms=20)
+    return model
+
+
+# The server starts accepting requests while the model loads and answers 503 until it is warm
+loader = BackgroundModelLoader(build_model).start()
 
 app = Flask(__name__, template_folder='/lfs/local/0/paridhi/MultimodalHateSpeech/Classification/')
 
@@ -24,18 +31,18 @@ def upload_file():
 @app.route('/infer', methods=['GET', 'POST'])
 def infer():
     if request.method == 'POST':
+        if not loader.ready.is_set():
+            return jsonify({'error': 'Model is still loading'}), 503
+        model = loader.model
         f = request.files['file']
-        event_id = datetime.now().strftime('%Y-%m-%d-%H-%M-%S-') + str(uuid4())
-        image_path = os.path.join(DATA_DIR, f'{event_id}.png')
-        f.save(image_path)
+        image_bytes = f.read()
         text = request.form.get('caption', '')
-        if text == '':
-            text = pytesseract.image_to_string(Image.open(image_path))
-        prob = model.infer(image_path, text)
+        # An empty caption makes infer_bytes fall back to OCR
+        prob = model.infer_bytes(image_bytes, text or None)
         # Logging
         logger.info('-'*100)
         logger.info(f'Text: {text}')
-        logger.info(f'Image Path: {image_path}')
+        logger.info(f'Image Name: {f.filename}')
         logger.info(f'Probability of Hateful: {prob:.3f}')
         logger.info('-'*100)
         return jsonify({'Hateful': prob})
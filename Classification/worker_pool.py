@@ -0,0 +1,178 @@
+import os
+import queue
+import atexit
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future
+
+import torch
+
+
+def _worker_main(model, index, inbox, results, num_threads):
+    # Each worker gets its own slice of the cores so workers do not oversubscribe them
+    torch.set_num_threads(num_threads)
+    # Archiving happens in the pool's parent process
+    model.batcher = None
+    model.archiver = None
+    model.warmup()
+    results.put((None, index, True, None))
+    while True:
+        request = inbox.get()
+        if request is None:
+            return
+        request_id, image_bytes, text = request
+        try:
+            results.put((request_id, index, True, model.infer_bytes(image_bytes, text)))
+        except Exception as e:
+            results.put((request_id, index, False, repr(e)))
+
+
+def _zygote_main(model_factory, inboxes, results, commands, num_threads, monitor_interval):
+    # Started with spawn, so this process has no threads of its own when it forks workers. Building the
+    # model may run forward passes (tracing for the torchscript backends), so torch is held to one thread
+    # here and no OpenMP worker threads exist to be lost in the fork; each worker sets its own count
+    torch.set_num_threads(1)
+    model = model_factory()
+    context = multiprocessing.get_context('fork')
+    parent = multiprocessing.parent_process()
+
+    def fork(index):
+        process = context.Process(target=_worker_main, name=f'model-worker-{index}', daemon=True,
+                                  args=(model, index, inboxes[index], results, num_threads))
+        process.start()
+        return process
+
+    processes = [fork(index) for index in range(len(inboxes))]
+    while parent is None or parent.is_alive():
+        try:
+            if commands.get(timeout=monitor_interval) is None:
+                break
+        except queue.Empty:
+            pass
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                # A replacement takes over the same inbox; the parent resubmits what the dead one held
+                results.put((None, index, False, process.exitcode))
+                processes[index] = fork(index)
+    for process in processes:
+        process.join(timeout=5)
+
+
+class WorkerPool:
+    '''
+    Runs `num_workers` inference processes forked from a zygote: a process started with spawn before any
+    worker exists, which builds the model with `model_factory` (a picklable callable) on a single torch
+    thread. The weights are shared copy-on-write, and since the zygote has no other threads, forking from it
+    cannot inherit a lock held by one, as forking from a threaded server could. Requests go to the
+    worker with the fewest outstanding requests, and the zygote forks a replacement for a worker that
+    dies. Requests a dead worker never answered are resubmitted once; a request that kills a second
+    worker fails instead of taking down the whole pool. Images are archived here, by `archiver`.
+
+    Exposes `infer_bytes`, `infer_batch` and `warmup` so it can stand in for HatefulMemesInference.
+    '''
+
+    def __init__(self, model_factory, num_workers=None, threads_per_worker=None, monitor_interval=1.0,
+                 archiver=None):
+        self.context = multiprocessing.get_context('spawn')
+        self.archiver = archiver
+        self.num_workers = num_workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(1, os.cpu_count() // self.num_workers)
+        # SimpleQueue writes from the calling thread, so the zygote never starts a feeder thread
+        self.results = self.context.SimpleQueue()
+        self.inboxes = [self.context.Queue() for _ in range(self.num_workers)]
+        self.commands = self.context.Queue()
+        self.load = [0] * self.num_workers
+        self.outstanding = {}  # Map from request id to (worker index, future, request, attempts)
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.started = threading.Semaphore(0)
+        self.restarts = 0
+        self.closed = False
+
+        self.zygote = self.context.Process(
+            target=_zygote_main, name='model-zygote',
+            args=(model_factory, self.inboxes, self.results, self.commands, self.threads_per_worker,
+                  monitor_interval))
+        self.zygote.start()
+        threading.Thread(target=self._collect, name='worker-pool-collector', daemon=True).start()
+        # Registered after multiprocessing's own exit handler, so it runs first: the zygote is not a daemon
+        # (daemons cannot fork), and exit would otherwise wait on it forever
+        atexit.register(self.close)
+
+    def warmup(self):
+        # Workers warm up on start; wait until each has reported in
+        for _ in range(self.num_workers):
+            self.started.acquire()
+
+    def submit(self, image_bytes, text):
+        future = Future()
+        if self.archiver is not None:
+            self.archiver.submit(image_bytes)
+        with self.lock:
+            self._dispatch(next(self.ids), future, (image_bytes, text))
+        return future
+
+    def _dispatch(self, request_id, future, request, attempts=1):
+        index = min(range(self.num_workers), key=lambda i: self.load[i])
+        self.load[index] += 1
+        self.outstanding[request_id] = (index, future, request, attempts)
+        self.inboxes[index].put((request_id,) + request)
+
+    def infer_bytes(self, image_bytes, text):
+        return self.submit(image_bytes, text).result()
+
+    def infer_batch(self, images_bytes, text):
+        # Spread over the workers, so the images are scored side by side rather than one after another
+        futures = [self.submit(image_bytes, text) for image_bytes in images_bytes]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        while True:
+            request_id, index, ok, value = self.results.get()
+            if request_id is None:
+                if ok:
+                    self.started.release()
+                else:
+                    self._restarted(index, value)
+                continue
+            with self.lock:
+                entry = self.outstanding.pop(request_id, None)
+                if entry is None:
+                    continue
+                self.load[entry[0]] -= 1
+            if ok:
+                entry[1].set_result(value)
+            else:
+                entry[1].set_exception(RuntimeError(value))
+
+    def _restarted(self, index, exitcode):
+        if self.closed:
+            return
+        print(f'Model worker {index} exited with code {exitcode}, restarting')
+        with self.lock:
+            self.restarts += 1
+            self.load[index] = 0
+            # Requests the dead worker never answered go to the least-loaded workers again. Its replacement
+            # may also answer some of them from the inbox; whichever answer comes second is ignored
+            lost = [(rid, entry) for rid, entry in self.outstanding.items() if entry[0] == index]
+            for request_id, (_, future, request, attempts) in lost:
+                del self.outstanding[request_id]
+                if attempts > 1:
+                    future.set_exception(RuntimeError('Model worker died twice on this request'))
+                else:
+                    self._dispatch(request_id, future, request, attempts + 1)
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.num_workers, 'load': list(self.load), 'restarts': self.restarts}
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # The zygote stops replacing workers before they are told to exit
+        self.commands.put(None)
+        for inbox in self.inboxes:
+            inbox.put(None)
+        self.zygote.join(timeout=10)
@@ -0,0 +1,123 @@
+'''
+Compares the spelling normalizers used before Perspective scoring.
+
+    python benchmarks/bench_normalizer.py [--messages messages.txt] [--perspective-key KEY]
+
+Reports per-message latency for each normalizer, how often its output matches the TextBlob output, and,
+given a Perspective key, how far the resulting Perspective scores move and how often the bot's
+auto-report decision (any flagged attribute above 0.8) agrees with the TextBlob path.
+'''
+import argparse
+import ast
+import json
+import os
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from normalizer import get_normalizer, NORMALIZERS  # noqa: E402
+from perspective import PERSPECTIVE_URL, PERSPECTIVE_ATTRIBUTES  # noqa: E402
+
+AUTO_REPORT_LABELS = ['SEVERE_TOXICITY', 'IDENTITY_ATTACK', 'THREAT']
+THRESH = 0.8
+
+SAMPLE_MESSAGES = [
+    'you can\'t be racist if there is no other race',
+    'I h4te youuuu, you are such an 1d10t!!',
+    'Thsi is a smple sentense with speling erors.',
+    'go back to where you came from, nobody wants your kind here',
+    'love the way you smell today',
+    'what a beautifull day to go outsidee and play with frends',
+    'u r so st00pid lmaooo',
+    'Dont forget the meeting tommorow at 10am in the confrence room',
+]
+
+
+def messages_from_log(path):
+    # Message contents from the gateway events dumped in discord.log
+    messages = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if "'t': 'MESSAGE_CREATE'" not in line:
+                continue
+            event = ast.literal_eval(line.split('WebSocket Event: ', 1)[1])
+            content = event['d'].get('content')
+            if content and not event['d']['author'].get('bot'):
+                messages.append(content)
+    return messages
+
+
+def perspective_scores(text, key):
+    data_dict = {
+        'comment': {'text': text},
+        'languages': ['en'],
+        'requestedAttributes': {attr: {} for attr in PERSPECTIVE_ATTRIBUTES},
+        'doNotStore': True
+    }
+    response_dict = requests.post(PERSPECTIVE_URL, params={'key': key}, json=data_dict, timeout=10).json()
+    time.sleep(1.0)  # Default Perspective quota is 1 QPS
+    return {attr: v['summaryScore']['value'] for attr, v in response_dict['attributeScores'].items()}
+
+
+def flagged(scores):
+    return any(scores.get(label, 0) > THRESH for label in AUTO_REPORT_LABELS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', help='text file with one message per line')
+    parser.add_argument('--log', default='discord.log')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the messages (later passes hit memoized tokens)')
+    parser.add_argument('--perspective-key')
+    args = parser.parse_args()
+
+    messages = list(SAMPLE_MESSAGES)
+    if os.path.exists(args.log):
+        messages += messages_from_log(args.log)
+    if args.messages:
+        with open(args.messages, encoding='utf-8') as f:
+            messages += [line.strip() for line in f if line.strip()]
+
+    results = {}
+    outputs = {}
+    for name in NORMALIZERS:
+        start = time.perf_counter()
+        normalize = get_normalizer(name)
+        setup = time.perf_counter() - start
+
+        latencies = {}
+        for run in range(args.repeat):
+            for i, message in enumerate(messages):
+                start = time.perf_counter()
+                out = normalize(message)
+                latencies.setdefault(run, []).append((time.perf_counter() - start) * 1000)
+                outputs.setdefault(name, {})[i] = out
+        results[name] = {
+            'setup_s': round(setup, 3),
+            'cold_mean_ms': round(statistics.mean(latencies[0]), 3),
+            'cold_max_ms': round(max(latencies[0]), 3),
+            'warm_mean_ms': round(statistics.mean(latencies[args.repeat - 1]), 3),
+        }
+
+    for name in NORMALIZERS:
+        same = sum(outputs[name][i] == outputs['textblob'][i] for i in range(len(messages)))
+        results[name]['matches_textblob'] = round(same / len(messages), 3)
+
+    if args.perspective_key:
+        baseline = [perspective_scores(outputs['textblob'][i], args.perspective_key) for i in range(len(messages))]
+        for name in NORMALIZERS:
+            if name == 'textblob':
+                continue
+            diffs, agree = [], 0
+            for i in range(len(messages)):
+                scores = perspective_scores(outputs[name][i], args.perspective_key)
+                diffs += [abs(scores[attr] - baseline[i][attr]) for attr in scores if attr in baseline[i]]
+                agree += flagged(scores) == flagged(baseline[i])
+            results[name]['perspective_mean_abs_diff'] = round(statistics.mean(diffs), 4)
+            results[name]['auto_report_agreement'] = round(agree / len(messages), 3)
+
+    print(f'{len(messages)} messages')
+    print(json.dumps(results, indent=2))
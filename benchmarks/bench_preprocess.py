@@ -0,0 +1,107 @@
+'''
+Per-sample preprocessing cost of mmf's BertTokenizer and TorchvisionTransforms processors against
+FastPreprocessor.
+
+    python benchmarks/bench_preprocess.py [--images HatefulMemesDataset/img] [--batch-sizes 1 8 32]
+
+Without --images, synthetic JPEG memes of typical sizes are used. For each batch size it reports the
+milliseconds per sample to go from encoded image bytes and caption to model-ready tensors, and checks
+parity: the largest and mean pixel difference after normalization and how often the token ids match.
+'''
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+import torch
+from omegaconf import OmegaConf
+from PIL import Image
+from mmf.common.sample import Sample
+from mmf.datasets.processors.bert_processors import BertTokenizer
+from mmf.datasets.processors.image_processors import TorchvisionTransforms
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fixtures import CAPTIONS, CLASSIFICATION_DIR, synthetic_memes  # noqa: E402
+sys.path.insert(0, CLASSIFICATION_DIR)
+from batching import collate  # noqa: E402
+from preprocess import FastPreprocessor  # noqa: E402
+
+
+def dataset_memes(image_dir, count):
+    names = sorted(os.listdir(image_dir))[:count]
+    memes = []
+    for i, name in enumerate(names):
+        with open(os.path.join(image_dir, name), 'rb') as f:
+            memes.append((f.read(), CAPTIONS[i % len(CAPTIONS)]))
+    return memes
+
+
+def mmf_batch(text_processor, image_processor, batch):
+    samples = []
+    for image_bytes, text in batch:
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        sample = Sample()
+        sample.image = image_processor({'image': image})['image']
+        sample.update(text_processor({'text': text}))
+        samples.append(sample)
+    return collate(samples)
+
+
+def per_sample_ms(fn, memes, batch_size, repeat):
+    timings = []
+    for _ in range(repeat):
+        for start in range(0, len(memes), batch_size):
+            batch = memes[start:start + batch_size]
+            begin = time.perf_counter()
+            fn(batch)
+            timings.append((time.perf_counter() - begin) * 1000 / len(batch))
+    return round(statistics.median(timings), 3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', help='directory of meme images, e.g. HatefulMemesDataset/img')
+    parser.add_argument('--count', type=int, default=64)
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    memes = dataset_memes(args.images, args.count) if args.images else synthetic_memes(args.count)
+
+    text_config = OmegaConf.load(os.path.join(CLASSIFICATION_DIR, 'text_processor_config.yaml'))
+    image_config = OmegaConf.load(os.path.join(CLASSIFICATION_DIR, 'image_processor_config.yaml'))
+    text_processor = BertTokenizer(text_config)
+    image_processor = TorchvisionTransforms(image_config)
+    fast = FastPreprocessor(text_config, image_config)
+
+    def run_mmf(batch):
+        return mmf_batch(text_processor, image_processor, batch)
+
+    def run_fast(batch):
+        return fast.batch([image for image, _ in batch], [text for _, text in batch])
+
+    results = {}
+    for batch_size in args.batch_sizes:
+        mmf_ms = per_sample_ms(run_mmf, memes, batch_size, args.repeat)
+        fast_ms = per_sample_ms(run_fast, memes, batch_size, args.repeat)
+        results[f'batch_{batch_size}'] = {'mmf_ms': mmf_ms, 'fast_ms': fast_ms, 'speedup': round(mmf_ms / fast_ms, 2)}
+
+    pixel_diffs, token_matches = [], 0
+    for meme in memes:
+        reference = run_mmf([meme])
+        candidate = run_fast([meme])
+        pixel_diffs.append((reference['image'] - candidate['image']).abs())
+        length = int(candidate['input_mask'].sum())
+        token_matches += torch.equal(reference['input_ids'][0, :length], candidate['input_ids'][0, :length])
+    results['parity'] = {
+        'max_pixel_diff': round(max(d.max().item() for d in pixel_diffs), 4),
+        'mean_pixel_diff': round(statistics.mean(d.mean().item() for d in pixel_diffs), 4),
+        'token_ids_match': round(token_matches / len(memes), 3),
+    }
+
+    print(f'{len(memes)} memes')
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,309 @@
+'''
+Offline stand-ins shared by the benchmarks: synthetic memes, channel-traffic traces, minimal fakes of the
+discord.py objects the bot reads, and a stand-in for the meme model.
+'''
+import ast
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import time
+import zlib
+from datetime import datetime
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLASSIFICATION_DIR = os.path.join(REPO_DIR, 'Classification')
+sys.path.insert(0, REPO_DIR)
+
+CAPTIONS = [
+    'you can\'t be racist if there is no other race',
+    'when you finally get the weekend off',
+    'look how many people love you',
+    'go back to where you came from, nobody wants your kind here and nobody ever will, '
+    'so pack your bags and leave before we make you',
+    'me',
+]
+MESSAGES = [
+    'anyone up for games tonight?',
+    'lol that was so funny',
+    'Thsi is a smple sentense with speling erors.',
+    'I h4te youuuu, you are such an 1d10t!!',
+    'what a beautifull day to go outsidee and play with frends',
+    'you are stupid and ugly, go die',
+    'Dont forget the meeting tommorow at 10am in the confrence room',
+    'u r so st00pid lmaooo',
+]
+SIZES = [(500, 500), (800, 600), (1200, 1200), (640, 960)]
+
+
+def synthetic_memes(count, seed=0):
+    '''
+    `count` (JPEG bytes, caption) pairs of typical meme sizes, with the caption drawn on the image.
+    '''
+    rng = np.random.default_rng(seed)
+    memes = []
+    for i in range(count):
+        width, height = SIZES[i % len(SIZES)]
+        image = Image.fromarray((rng.random((height, width, 3)) * 255).astype('uint8')).filter(ImageFilter.GaussianBlur(6))
+        caption = CAPTIONS[i % len(CAPTIONS)]
+        ImageDraw.Draw(image).text((width // 10, height // 10), caption, fill=(255, 255, 255))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        memes.append((buffer.getvalue(), caption))
+    return memes
+
+
+def synthetic_trace(count, rate=5.0, meme_rate=0.2, repost_rate=0.1, edit_rate=0.0, unfurl_rate=0.5, seed=0):
+    '''
+    Channel traffic as a list of events arriving at `rate` a second. Messages are
+    {'t': seconds since start, 'type': 'create', 'id': ..., 'content': ..., 'attachments': [...]}, and with
+    `edit_rate` that share of events are {'type': 'edit', 'id': ...} edits of a recent message. An edit
+    carries new 'content' and 'attachments', except for the `unfurl_rate` share that only adds an embed.
+    Attachment names refer to stub_server's /attachments route.
+    '''
+    rng = random.Random(seed)
+    events, created, t = [], [], 0.0
+    for i in range(count):
+        t += rng.expovariate(rate)
+        if edit_rate and created and rng.random() < edit_rate:
+            original = created[-min(len(created), 1 + int(rng.expovariate(0.5)))]
+            edit = {'t': round(t, 3), 'type': 'edit', 'id': original['id']}
+            if rng.random() >= unfurl_rate:
+                edit['content'] = original['content'] + rng.choice([' lol', '!!', ' (edited)'])
+                edit['attachments'] = original['attachments']
+            events.append(edit)
+            continue
+        attachments = []
+        if rng.random() < meme_rate:
+            # Reposts reuse an earlier image, as happens when a meme goes around a server
+            index = rng.randrange(max(1, i)) if rng.random() < repost_rate else i
+            attachments.append(f'meme-{index}.png')
+        content = rng.choice(CAPTIONS if attachments else MESSAGES)
+        event = {'t': round(t, 3), 'type': 'create', 'id': len(created) + 1, 'content': content,
+                 'attachments': attachments}
+        created.append(event)
+        events.append(event)
+    return events
+
+
+def trace_from_log(path):
+    # Guild messages and their edits from the gateway events dumped in discord.log
+    events, start = [], None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if "'t': 'MESSAGE_CREATE'" in line:
+                kind = 'create'
+            elif "'t': 'MESSAGE_UPDATE'" in line:
+                kind = 'edit'
+            else:
+                continue
+            data = ast.literal_eval(line.split('WebSocket Event: ', 1)[1])['d']
+            if data.get('author', {}).get('bot') or 'guild_id' not in data:
+                continue
+            timestamp = data.get('edited_timestamp') or data.get('timestamp')
+            if timestamp is None:
+                # Embed-only updates carry no timestamp; they arrive right after the previous event
+                t = events[-1]['t'] if events else 0.0
+            else:
+                timestamp = datetime.fromisoformat(timestamp).timestamp()
+                start = timestamp if start is None else start
+                t = round(timestamp - start, 3)
+            event = {'t': t, 'type': kind, 'id': int(data['id'])}
+            if kind == 'create' or 'content' in data:
+                event['content'] = data.get('content', '')
+                event['attachments'] = [a['filename'] for a in data.get('attachments', [])]
+            events.append(event)
+    # Edits are logged when they happen, which may be after messages created later
+    return sorted(events, key=lambda event: event['t'])
+
+
+def load_trace(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class FakeUser:
+    def __init__(self, id, name='user', bot=False):
+        self.id = id
+        self.name = name
+        self.bot = bot
+        self.sent = []
+
+    async def send(self, content=None, embed=None):
+        self.sent.append(content)
+
+
+class FakeGuild:
+    def __init__(self, id=1):
+        self.id = id
+
+
+class FakeChannel:
+    '''
+    A text channel that records what is sent to it.
+    '''
+    def __init__(self, id, name, guild):
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.sent = []
+        self.messages = {}
+
+    async def send(self, content=None, embed=None):
+        self.sent.append((time.perf_counter(), content))
+
+    async def fetch_message(self, message_id):
+        return self.messages[message_id]
+
+
+class FakeAttachment:
+    def __init__(self, url):
+        self.url = url
+        self.filename = url.rsplit('/', 1)[-1]
+        self.id = attachment_id(self.filename)
+
+
+class FakeEmbed:
+    def __init__(self, data):
+        self.type = data.get('type', 'rich')
+        self.url = data.get('url')
+        self.image = FakeEmbedImage(data.get('image', {}))
+        self.thumbnail = FakeEmbedImage(data.get('thumbnail', {}))
+
+
+class FakeEmbedImage:
+    def __init__(self, data):
+        self.url = data.get('url')
+        self.proxy_url = data.get('proxy_url')
+
+
+def attachment_id(filename):
+    # Stable per file, so an edit that keeps an attachment keeps its id as on Discord
+    return zlib.crc32(filename.encode())
+
+
+class FakeMessage:
+    def __init__(self, id, content, author, channel, attachments=()):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.attachments = list(attachments)
+        self.embeds = []
+        self.jump_url = f'https://discord.com/channels/{channel.guild.id}/{channel.id}/{id}'
+        channel.messages[id] = self
+
+    async def add_reaction(self, emoji):
+        pass
+
+    def _update(self, data):
+        # Partial MESSAGE_UPDATE, as discord.Message._update applies it
+        if 'content' in data:
+            self.content = data['content']
+        if 'embeds' in data:
+            self.embeds = [FakeEmbed(embed) for embed in data['embeds']]
+        if 'attachments' in data:
+            self.attachments = [FakeAttachment(a['url']) for a in data['attachments']]
+
+
+class FakeRawMessageUpdate:
+    '''
+    Stands in for discord.RawMessageUpdateEvent: the raw MESSAGE_UPDATE payload and the ids it refers to.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.message_id = int(data['id'])
+        self.channel_id = int(data['channel_id'])
+        self.guild_id = int(data['guild_id']) if 'guild_id' in data else None
+        self.cached_message = None
+
+
+def edit_payload(event, channel, author, attachment_url):
+    '''
+    Gateway MESSAGE_UPDATE data for an edit event. Content edits carry the whole message, like Discord
+    sends them; edits without 'content' only add an embed, like a link unfurling.
+    '''
+    data = {'id': str(event['id']), 'channel_id': str(channel.id), 'guild_id': str(channel.guild.id)}
+    if 'content' not in event:
+        data['embeds'] = [{'type': 'link', 'url': 'https://example.com/', 'title': 'example'}]
+        return data
+    data.update({
+        'author': {'id': str(author.id), 'username': author.name, 'discriminator': '0000', 'avatar': None},
+        'content': event['content'],
+        'attachments': [{'id': str(attachment_id(name)), 'filename': name, 'size': 0, 'url': f'{attachment_url}/{name}',
+                         'proxy_url': f'{attachment_url}/{name}'} for name in event['attachments']],
+        'embeds': [],
+        'mentions': [],
+        'mention_roles': [],
+        'mention_everyone': False,
+        'pinned': False,
+        'tts': False,
+        'type': 0,
+        'timestamp': datetime.now().astimezone().isoformat(),
+        'edited_timestamp': datetime.now().astimezone().isoformat(),
+    })
+    return data
+
+
+class StandInModel:
+    '''
+    Replaces HatefulMemesInference in bot benchmarks: a fixed service time and a score derived from the
+    image bytes, so runs are repeatable without mmf.
+    '''
+    def __init__(self, service_ms=50):
+        self.service_ms = service_ms
+
+    def infer_bytes(self, image_bytes, text):
+        return self.infer_batch([image_bytes], text)[0]
+
+    def infer_batch(self, images_bytes, text):
+        # One forward pass whatever the batch size, as with the real model at these sizes
+        time.sleep(self.service_ms / 1000)
+        return [int(hashlib.sha256(image_bytes).hexdigest()[:4], 16) / 0xFFFF for image_bytes in images_bytes]
+
+    def confirm(self, image_bytes):
+        pass
+
+    def save_duplicate_index(self):
+        pass
+
+
+def build_bot(data_dir, perspective_url, model, group_num='0'):
+    '''
+    A ModBot that is never connected: its group and mod channels are fakes, and its state lives in
+    `data_dir`. Returns (bot, group channel, mod channel).
+    '''
+    from bot import ModBot
+    bot = ModBot('stub-key', perspective_url=perspective_url, perspective_qps=1000.0, data_dir=data_dir)
+    bot.group_num = group_num
+    guild = FakeGuild()
+    group_channel = FakeChannel(10, f'group-{group_num}', guild)
+    mod_channel = FakeChannel(11, f'group-{group_num}-mod', guild)
+    bot.mod_channels[guild.id] = mod_channel
+    bot.mod_channel = mod_channel
+    # What on_message and on_raw_message_edit would otherwise get from the gateway connection
+    bot._connection.user = FakeUser(1, f'Group {group_num} Bot', bot=True)
+    bot.get_channel = {channel.id: channel for channel in (group_channel, mod_channel)}.get
+    if model is not None:
+        bot.set_model(model)
+    return bot, group_channel, mod_channel
+
+
+async def start_stub_server(latency_ms=0, failure_rate=0.0):
+    '''
+    Runs stub_server in this process on a free port. Returns (runner, base URL).
+    '''
+    from aiohttp import web
+    from stub_server import make_app
+    runner = web.AppRunner(make_app(latency_ms, failure_rate))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
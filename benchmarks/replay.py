@@ -0,0 +1,208 @@
+'''
+Replays recorded or synthetic channel traffic through the bot without connecting to Discord.
+
+    python benchmarks/replay.py --log discord.log --speed 1
+    python benchmarks/replay.py --messages 2000 --rate 50 --edit-rate 0.2 --speed 10
+    python benchmarks/replay.py --trace trace.jsonl --speed 0 --model real
+
+Messages are delivered to ModBot.on_message and edits to ModBot.on_raw_message_edit, spaced as in the
+trace divided by --speed (0 replays as fast as possible). Perspective and the Discord CDN are served by
+stub_server in this process unless --perspective-url / --attachment-url point elsewhere, and the meme model
+is StandInModel unless --model real loads HatefulMemesInference (or --model none scores text only).
+
+Reports throughput, latency percentiles of new messages from delivery to the handler returning and of edits,
+which are debounced and scored in the background, from delivery to the end of the task that re-scores them,
+what became of the edits, the mean time per pipeline stage, and the depth of the scoring queues (messages
+waiting for a slot and in flight, texts waiting for the Perspective rate limit, pending reports) sampled
+while the trace plays.
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fixtures import (CLASSIFICATION_DIR, FakeAttachment, FakeMessage, FakeRawMessageUpdate, FakeUser,  # noqa: E402
+                      StandInModel, build_bot, edit_payload, load_trace, start_stub_server, synthetic_trace,
+                      trace_from_log)
+
+QUEUES = {
+    'scorer_waiting': lambda bot: bot.scorer.waiting,
+    'scorer_in_flight': lambda bot: bot.scorer.in_flight,
+    'perspective_queue': lambda bot: len(bot.scorer.perspective.queue),
+    'pending_reports': lambda bot: bot.report_store.pending_count(),
+}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {'p50': percentile(values, 50), 'p90': percentile(values, 90), 'p99': percentile(values, 99),
+            'max': max(values)}
+
+
+def edit_outcomes():
+    from bot import EDITS
+    with EDITS.lock:
+        return {','.join(f'{name}={value}' for name, value in key): count for key, count in EDITS.values.items()}
+
+
+def stage_totals():
+    # (sum, count) per stage recorded so far by the pipeline's timers
+    from Classification.metrics import STAGE_SECONDS
+    with STAGE_SECONDS.lock:
+        return {dict(key)['stage']: (entry[-2], entry[-1]) for key, entry in STAGE_SECONDS.values.items()}
+
+
+async def sample_queues(bot, samples, interval):
+    while True:
+        for name, depth in QUEUES.items():
+            samples[name].append(depth(bot))
+        await asyncio.sleep(interval)
+
+
+async def run_replay(trace, speed=1.0, model=None, perspective_url=None, attachment_url=None, stub_latency_ms=20,
+                     sample_interval=0.1):
+    '''
+    Plays `trace` (see fixtures.synthetic_trace for the event format) through a fresh bot and returns its
+    statistics. Stub services are started for whichever of `perspective_url` and `attachment_url` is None.
+    '''
+    runner = None
+    if perspective_url is None or attachment_url is None:
+        runner, base_url = await start_stub_server(stub_latency_ms)
+        perspective_url = perspective_url or f'{base_url}/v1alpha1/comments:analyze'
+        attachment_url = attachment_url or f'{base_url}/attachments'
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        bot, channel, mod_channel = build_bot(data_dir, perspective_url, model)
+        authors = {}
+        latencies = {'create': [], 'edit': []}
+        edit_tasks = {}  # Map from message id to (arrival, re-scoring task) of its edits, in the order they came
+        finished = {}  # Map from re-scoring task to when it finished
+        samples = {name: [] for name in QUEUES}
+        stages_before = stage_totals()
+        edits_before = edit_outcomes()
+
+        async def deliver(event, arrival):
+            kind = event.get('type', 'create')
+            if kind == 'create':
+                author = authors.setdefault(event.get('author', 1000), FakeUser(event.get('author', 1000)))
+                attachments = [FakeAttachment(f'{attachment_url}/{name}') for name in event['attachments']]
+                await bot.on_message(FakeMessage(event['id'], event['content'], author, channel, attachments))
+            else:
+                author = authors.setdefault(1000, FakeUser(1000))
+                payload = FakeRawMessageUpdate(edit_payload(event, channel, author, attachment_url))
+                await bot.on_raw_message_edit(payload)
+                task = bot.pending_edits.get(payload.message_id)
+                if task is not None:
+                    # Timed once the messages are all scored, when it is known which task re-scored the edit
+                    task.add_done_callback(lambda task: finished.setdefault(task, time.perf_counter()))
+                    edit_tasks.setdefault(payload.message_id, []).append((arrival, task))
+                    return
+            latencies[kind].append((time.perf_counter() - arrival) * 1000)
+
+        sampler = asyncio.ensure_future(sample_queues(bot, samples, sample_interval))
+        tasks = []
+        start = time.perf_counter()
+        for i, event in enumerate(trace):
+            event.setdefault('id', i + 1)
+            if speed > 0:
+                delay = start + event['t'] / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(deliver(event, time.perf_counter())))
+        await asyncio.gather(*tasks)
+        # Edits are scored by tasks of their own once each message's burst of edits has settled
+        while bot.pending_edits:
+            await asyncio.gather(*bot.pending_edits.values(), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        sampler.cancel()
+        # A newer edit of the same message cancels the task scheduled for an older one, whose changes are then
+        # re-scored by the first later task that was not cancelled
+        for edits in edit_tasks.values():
+            for i, (arrival, _) in enumerate(edits):
+                task = next(task for _, task in edits[i:] if not task.cancelled())
+                latencies['edit'].append((finished[task] - arrival) * 1000)
+
+        stages = {}
+        for stage, (total, count) in stage_totals().items():
+            total_before, count_before = stages_before.get(stage, (0.0, 0))
+            if count > count_before:
+                stages[stage] = (total - total_before) / (count - count_before) * 1000
+
+        results = {
+            'events': len(trace),
+            'edits': len(latencies['edit']),
+            'elapsed_s': elapsed,
+            'events_per_s': len(trace) / elapsed,
+            'latency_ms': percentiles(latencies['create']),
+            'edit_latency_ms': percentiles(latencies['edit']),
+            'edit_outcomes': {outcome: count - edits_before.get(outcome, 0)
+                              for outcome, count in edit_outcomes().items() if count > edits_before.get(outcome, 0)},
+            'stage_mean_ms': stages,
+            'queues': {name: {'max': max(values), 'mean': statistics.mean(values)}
+                       for name, values in samples.items() if values},
+            'flagged': sum(1 for _, content in mod_channel.sent if content and content.startswith('Message flagged')),
+            'score_cache': bot.scorer.cache.stats(),
+            'message_cache': bot.message_cache.stats(),
+        }
+        await bot.scorer.close()
+        bot.report_store.close()
+    if runner is not None:
+        await runner.cleanup()
+    return results
+
+
+def load_model(name, service_ms=50, fast_preprocess=False):
+    if name == 'none':
+        return None
+    if name == 'standin':
+        return StandInModel(service_ms)
+    # Imported as the bot imports it, so its stage timers land in the same registry
+    from Classification.inference import HatefulMemesInference
+    return HatefulMemesInference(CLASSIFICATION_DIR, fast_preprocess=fast_preprocess)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', default=None, help='JSONL trace, as written by --save-trace')
+    parser.add_argument('--log', default=None, help='discord.log whose guild messages and edits are replayed')
+    parser.add_argument('--messages', type=int, default=500, help='length of the synthetic trace')
+    parser.add_argument('--rate', type=float, default=20.0, help='events a second in the synthetic trace')
+    parser.add_argument('--edit-rate', type=float, default=0.1, help='share of synthetic events that are edits')
+    parser.add_argument('--save-trace', default=None, help='write the trace that was replayed as JSONL')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 for real time, 10 for 10x, 0 for max')
+    parser.add_argument('--model', choices=['standin', 'real', 'none'], default='standin')
+    parser.add_argument('--model-ms', type=int, default=50, help='service time of the stand-in model')
+    parser.add_argument('--fast-preprocess', action='store_true')
+    parser.add_argument('--perspective-url', default=None)
+    parser.add_argument('--attachment-url', default=None, help='base URL that attachment names are appended to')
+    parser.add_argument('--stub-latency-ms', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    elif args.log:
+        trace = trace_from_log(args.log)
+    else:
+        trace = synthetic_trace(args.messages, rate=args.rate, edit_rate=args.edit_rate)
+    if args.save_trace:
+        with open(args.save_trace, 'w', encoding='utf-8') as f:
+            for event in trace:
+                f.write(json.dumps(event) + '\n')
+
+    model = load_model(args.model, args.model_ms, args.fast_preprocess)
+    print(f'Replaying {len(trace)} events at {"max" if args.speed <= 0 else f"{args.speed:g}x"} speed')
+    results = asyncio.run(run_replay(trace, args.speed, model, args.perspective_url, args.attachment_url,
+                                     args.stub_latency_ms))
+    print(json.dumps(results, indent=2))
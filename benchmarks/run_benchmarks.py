@@ -0,0 +1,217 @@
+'''
+Offline benchmark suite for the classification and bot hot paths. Results are written as JSON so builds
+can be compared against each other.
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --suites replay --trace trace.jsonl --speed 0
+    python benchmarks/run_benchmarks.py --baseline main.json --thresholds benchmarks/thresholds.json
+
+Suites:
+  normalize  SymSpellNormalizer load time and per-message latency with a cold and a warm word cache
+  ocr        OCRPipeline latency per synthetic meme (needs tesserocr or pytesseract)
+  model      per model_type: `_prepare_sample` and `test` latency, and `test_batch` throughput (needs mmf)
+  replay     a channel-traffic trace played through ModBot.on_message by benchmarks/replay.py, with
+             stub_server standing in for Perspective and the Discord CDN and StandInModel for the model
+
+The trace is synthetic unless --trace (JSONL from fixtures.synthetic_trace) or --log (a discord.log with
+gateway events) is given. A suite whose dependencies are missing is recorded under "skipped". With
+--baseline, every metric matching a pattern in --thresholds is compared against the baseline run and the
+exit status is 1 if any of them regressed past its tolerance.
+'''
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fixtures import (CLASSIFICATION_DIR, MESSAGES, REPO_DIR, load_trace, synthetic_memes,  # noqa: E402
+                      synthetic_trace, trace_from_log)
+from replay import load_model, percentile, run_replay  # noqa: E402
+
+SUITES = ['normalize', 'ocr', 'model', 'replay']
+MODEL_TYPES = ['unimodal_text', 'unimodal_image', 'concat_bert', 'late_fusion']
+DEFAULT_THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+
+def time_each(fn, items):
+    # Milliseconds taken by `fn` on each item
+    timings = []
+    for item in items:
+        start = time.perf_counter()
+        fn(*item)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def bench_normalize(args):
+    from normalizer import SymSpellNormalizer
+    start = time.perf_counter()
+    normalize = SymSpellNormalizer()
+    load_ms = (time.perf_counter() - start) * 1000
+    messages = [(text,) for text in MESSAGES] * max(1, args.iterations // len(MESSAGES))
+    # The first pass fills the word cache, later passes are what a busy channel mostly sees
+    cold = time_each(normalize, messages[:len(MESSAGES)])
+    warm = time_each(normalize, messages)
+    return {
+        'normalize.load_ms': load_ms,
+        'normalize.cold_ms': statistics.median(cold),
+        'normalize.warm_ms': statistics.median(warm),
+        'normalize.warm_p99_ms': percentile(warm, 99),
+    }
+
+
+def bench_ocr(args):
+    import io
+    from PIL import Image
+    sys.path.insert(0, CLASSIFICATION_DIR)
+    from ocr import OCRPipeline
+    images = [(Image.open(io.BytesIO(image_bytes)).convert('RGB'),) for image_bytes, _ in synthetic_memes(args.iterations)]
+    # Caching is off so every image goes through OCR rather than the hash lookup
+    ocr = OCRPipeline(cache_size=0)
+    timings = time_each(ocr.image_to_string, images)
+    return {
+        'ocr.ms': statistics.median(timings),
+        'ocr.p99_ms': percentile(timings, 99),
+    }
+
+
+def bench_model(args):
+    sys.path.insert(0, CLASSIFICATION_DIR)
+    from inference import HatefulMemesInference
+    memes = synthetic_memes(args.iterations)
+    results = {}
+    for model_type in args.model_types:
+        model = HatefulMemesInference(CLASSIFICATION_DIR, model_type=model_type, fast_preprocess=args.fast_preprocess)
+        model.warmup()
+        prefix = f'model.{model_type}'
+        results[f'{prefix}.prepare_sample_ms'] = statistics.median(time_each(model._prepare_sample, memes))
+        results[f'{prefix}.test_ms'] = statistics.median(time_each(model.test, memes))
+
+        batches = [memes[i:i + args.batch_size] for i in range(0, len(memes), args.batch_size)]
+        start = time.perf_counter()
+        for batch in batches:
+            model.test_batch([image for image, _ in batch], [text for _, text in batch])
+        results[f'{prefix}.batch_memes_per_s'] = len(memes) / (time.perf_counter() - start)
+        print(f'{model_type}: {results[f"{prefix}.test_ms"]:.1f}ms per meme, '
+              f'{results[f"{prefix}.batch_memes_per_s"]:.1f} memes/s batched')
+    return results
+
+
+def bench_replay(args):
+    if args.trace:
+        trace = load_trace(args.trace)
+    elif args.log:
+        trace = trace_from_log(args.log)
+    else:
+        trace = synthetic_trace(args.messages, rate=args.rate)
+    print(f'Replaying {len(trace)} messages at {"max" if args.speed <= 0 else f"{args.speed:g}x"} speed')
+    model = load_model('real' if args.real_model else 'standin', args.model_ms, args.fast_preprocess)
+    stats = asyncio.run(run_replay(trace, args.speed, model, stub_latency_ms=args.stub_latency_ms))
+    return {
+        'replay.msgs_per_s': stats['events_per_s'],
+        'replay.p50_ms': stats['latency_ms']['p50'],
+        'replay.p99_ms': stats['latency_ms']['p99'],
+        'replay.flagged': stats['flagged'],
+        'replay.score_cache_hit_rate': stats['score_cache']['hit_rate'],
+    }
+
+
+BENCHMARKS = {
+    'normalize': bench_normalize,
+    'ocr': bench_ocr,
+    'model': bench_model,
+    'replay': bench_replay,
+}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    versions = {'python': platform.python_version()}
+    for module in ['torch', 'mmf', 'discord', 'aiohttp', 'PIL']:
+        try:
+            versions[module] = __import__(module).__version__
+        except (ImportError, AttributeError):
+            versions[module] = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions,
+    }
+
+
+def compare(results, baseline, thresholds):
+    '''
+    Returns a list of (metric, baseline value, current value, change) for every metric that moved past its
+    tolerance in the wrong direction. The first matching pattern in `thresholds` applies.
+    '''
+    regressions = []
+    for metric, value in sorted(results.items()):
+        base = baseline.get(metric)
+        if base is None or not base:
+            continue
+        rule = next((rule for pattern, rule in thresholds.items() if fnmatch.fnmatch(metric, pattern)), None)
+        if rule is None:
+            continue
+        change = (value - base) / abs(base)
+        worse = change > rule['tolerance'] if rule['better'] == 'lower' else change < -rule['tolerance']
+        print(f'{"REGRESSED" if worse else "ok":>9}  {metric:<45} {base:>10.2f} -> {value:>10.2f} ({change:+.1%})')
+        if worse:
+            regressions.append((metric, base, value, change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=SUITES)
+    parser.add_argument('--output', default=None, help='write the results JSON here as well as to stdout')
+    parser.add_argument('--iterations', type=int, default=64, help='memes or messages timed per stage')
+    parser.add_argument('--model-types', nargs='+', choices=MODEL_TYPES, default=MODEL_TYPES)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--fast-preprocess', action='store_true')
+    parser.add_argument('--trace', default=None, help='JSONL trace of channel messages to replay')
+    parser.add_argument('--log', default=None, help='discord.log whose guild messages are replayed')
+    parser.add_argument('--messages', type=int, default=500, help='length of the synthetic trace')
+    parser.add_argument('--rate', type=float, default=20.0, help='messages a second in the synthetic trace')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed-up; 0 replays as fast as possible')
+    parser.add_argument('--stub-latency-ms', type=int, default=20)
+    parser.add_argument('--model-ms', type=int, default=50, help='service time of the stand-in meme model')
+    parser.add_argument('--real-model', action='store_true', help='replay with HatefulMemesInference')
+    parser.add_argument('--baseline', default=None, help='results JSON of an earlier run to compare against')
+    parser.add_argument('--thresholds', default=DEFAULT_THRESHOLDS)
+    args = parser.parse_args()
+
+    results, skipped = {}, {}
+    for suite in args.suites:
+        try:
+            results.update(BENCHMARKS[suite](args))
+        except ImportError as e:
+            print(f'Skipping {suite}: {e}')
+            skipped[suite] = str(e)
+
+    output = {'meta': metadata(), 'results': results, 'skipped': skipped}
+    print(json.dumps(output, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+        regressions = compare(results, baseline, thresholds)
+        if regressions:
+            print(f'{len(regressions)} metrics regressed against {args.baseline}')
+            sys.exit(1)
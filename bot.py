@@ -1,46 +1,59 @@
 # bot.py
+import asyncio
 import json
 import logging
+import logging.handlers
 import os
 import re
-from enum import Enum, auto
-from queue import PriorityQueue
+import time
 import discord
-import requests
-from unidecode import unidecode
-from textblob import TextBlob
 
 from report import Report
 from review import Review
-
-from Classification.inference import HatefulMemesInference
-
-# Set up logging to the console
-logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
-
-# There should be a file called 'token.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f'{token_path} not found!')
-
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    perspective_key = tokens['perspective']
-
-
-class Mode(Enum):
-    REPORT = auto()
-    REVIEW = auto()
+from scoring import ScoringPipeline
+from cache import ScoreCache
+from report_store import ReportStore
+from message_cache import MessageCache, image_name, image_urls, numbered_lines
+from perspective import AMBIENT, PERSPECTIVE_URL
+
+from Classification.loader import BackgroundModelLoader, timed
+from Classification.metrics import REGISTRY, new_trace, start_metrics_server, timer
+
+# Longest message Discord accepts
+MESSAGE_LIMIT = 2000
+# Local port serving Prometheus metrics at /metrics
+METRICS_PORT = 9108
+# Log every stage timing with the trace ID of its message to discord.log
+TRACE_STAGES = False
+# Score memes with CascadeScorer, which needs Classification/cascade_thresholds.json (see cascade.py)
+CASCADE = False
+# A message is re-scored once it has gone this long without another edit
+EDIT_DEBOUNCE_SECONDS = 1.0
+# ... but no later than this long after the first edit it has not been scored since
+EDIT_MAX_DELAY_SECONDS = 10.0
+
+MESSAGES = REGISTRY.counter('messages_total', 'Channel messages scored, by whether they were flagged')
+EDITS = REGISTRY.counter('edits_total', 'Message edits, by what was done with them')
+
+moderation_logger = logging.getLogger('moderation')
+
+
+def build_model():
+    # Imported here so that mmf and torch load on the background thread, after the bot has connected.
+    # Most memes posted without a caption are photos, so OCR is skipped for images with no text-like edges
+    if CASCADE:
+        from Classification.cascade import CascadeScorer
+        model = CascadeScorer('Classification', skip_textless_ocr=True)
+    else:
+        from Classification.inference import HatefulMemesInference
+        model = HatefulMemesInference('Classification', skip_textless_ocr=True)
+    model.enable_batching(max_batch_size=8, max_wait_ms=20)
+    model.enable_duplicate_index('Classification/phash_index.pkl')
+    return model
 
 
 class ModBot(discord.Client):
-    def __init__(self, key):
+    def __init__(self, key, perspective_url=PERSPECTIVE_URL, perspective_qps=1.0, data_dir='.'):
         intents = discord.Intents.default()
         super().__init__(command_prefix='.', intents=intents)
         self.group_num = None
@@ -49,14 +62,68 @@ class ModBot(discord.Client):
         self.reports = {}  # Map from user IDs to the state of their report
         self.reviews = {}
         self.perspective_key = key
-        self.mode = None
-        self.pending_reports = PriorityQueue()
-        self.message_report_map = {} # Map message link to the reports
-
-        # Loading inference model
-        self.model = HatefulMemesInference('Classification')
+        self.message_cache = MessageCache()
+        self.pending_edits = {}  # Map from message id to the task that re-scores it once its edits settle
+        self.first_edits = {}  # Map from message id to when its first edit since it was last scored arrived
+
+        self.startup_timings = {}
+        self.started_at = time.perf_counter()
+        self.metrics_server = None
+
+        # The inference model is loaded in the background once connected; until then only text is scored
+        self.model = None
+        self.model_loader = BackgroundModelLoader(build_model, on_ready=self.set_model)
+        with timed('report store', self.startup_timings):
+            # Reports are kept on disk so the moderation backlog survives restarts
+            self.report_store = ReportStore(os.path.join(data_dir, 'reports.db'))
+        print(f'Recovered {self.report_store.pending_count()} pending reports')
+        with timed('scoring pipeline', self.startup_timings):
+            # One image worker per batch slot so concurrent messages can be batched together. The pipeline's
+            # spelling dictionary loads on its own executor, so this returns at once
+            self.scorer = ScoringPipeline(None, key, image_workers=8,
+                                          cache=ScoreCache(db_path=os.path.join(data_dir, 'score_cache.db')),
+                                          perspective_url=perspective_url, perspective_qps=perspective_qps)
+
+    def set_model(self, model):
+        # Called from the loader thread once the model is warm
+        self.model = model
+        self.scorer.model = model
+        self.startup_timings.update(self.model_loader.timings)
+        print(f'Model ready, {time.perf_counter() - self.started_at:.2f}s after startup')
+
+    async def close(self):
+        for task in self.pending_edits.values():
+            task.cancel()
+        if self.model is not None:
+            self.model.save_duplicate_index()
+        await self.scorer.close()
+        self.report_store.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.cleanup()
+        await super().close()
 
     async def on_ready(self):
+        if 'discord connect' not in self.startup_timings:
+            self.startup_timings['discord connect'] = time.perf_counter() - self.started_at
+            print(f"Startup phase 'discord connect' took {self.startup_timings['discord connect']:.2f}s")
+        self.model_loader.start()
+        if self.metrics_server is None:
+            self.metrics_server = await start_metrics_server(port=METRICS_PORT)
+            REGISTRY.gauge('pending_reports', 'Reports waiting for review', self.report_store.pending_count)
+            REGISTRY.gauge('score_cache_hit_rate', 'Share of score lookups served from the cache',
+                           lambda: self.scorer.cache.stats()['hit_rate'])
+            REGISTRY.gauge('message_cache_hit_rate', 'Share of message lookups served without a Discord fetch',
+                           lambda: self.message_cache.stats()['hit_rate'])
+            REGISTRY.gauge('perspective_queue_depth', 'Texts waiting for the Perspective rate limit',
+                           lambda: len(self.scorer.perspective.queue))
+            for name, help_text in [('sent', 'Perspective requests sent'),
+                                    ('deduped', 'Texts that shared a Perspective request already queued or in flight'),
+                                    ('dropped', 'Texts dropped over the Perspective budget, scored by the model alone'),
+                                    ('errors', 'Perspective requests that failed')]:
+                REGISTRY.gauge(f'perspective_{name}', help_text,
+                               lambda name=name: self.scorer.perspective.stats()[name])
+            REGISTRY.gauge('model_ready', '1 once the meme model has loaded', lambda: int(self.model is not None))
+
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
         for guild in self.guilds:
             print(f' - {guild.name}')
@@ -87,6 +154,7 @@ class ModBot(discord.Client):
 
         # Check if this message was sent in a server ("guild") or if it's a DM
         if message.guild:
+            self.message_cache.put(message)
             await self.handle_channel_message(message)
         else:
             await self.handle_dm(message)
@@ -96,18 +164,21 @@ class ModBot(discord.Client):
         if message.content == Report.HELP_KEYWORD:
             reply = "Use the `report/review` command to begin the reporting/reviewing process.\n"
             reply += "Use the `cancel` command to cancel the report/review process.\n"
+            reply += "Use the `queue` command to see the pending review queue, how fast it is moving and the message cache hit rate.\n"
             await message.channel.send(reply)
             return
 
+        if message.content == Review.STATS_KEYWORD:
+            stats = {'review queue': self.report_store.stats(), 'message cache': self.message_cache.stats()}
+            await message.channel.send(self.code_format(json.dumps(stats, indent=2)))
+            return
+
+        # Each user has their own report or review session, so any number of users can report and any
+        # number of moderators can review at the same time
         author_id = message.author.id
         responses = []
 
-        if self.mode == Mode.REPORT or message.content.startswith(Report.START_KEYWORD):
-            # Only respond to messages if they're part of a reporting flow
-            # if author_id not in self.reports:
-            #     return
-            self.mode = Mode.REPORT
-
+        if author_id in self.reports or message.content.startswith(Report.START_KEYWORD):
             # If we don't currently have an active report for this user, add one
             if author_id not in self.reports:
                 self.reports[author_id] = \
@@ -124,17 +195,14 @@ class ModBot(discord.Client):
 
             # If the report is complete or cancelled, remove it from our map
             if self.reports[author_id].report_complete():
-                self.mode = None
                 self.reports.pop(author_id)
 
-        elif self.mode == Mode.REVIEW or message.content.startswith(Review.START_KEYWORD):
-            self.mode = Mode.REVIEW
+        elif author_id in self.reviews or message.content.startswith(Review.START_KEYWORD):
             if author_id in self.reviews and \
                     self.reviews[author_id].awaiting_next_action():
                 self.reviews[author_id].set_review_complete()
                 self.reviews.pop(author_id)
                 if not message.content.startswith(Review.CONTINUE_KEYWORD):
-                    self.mode = None
                     await message.channel.send("Review stopped")
                     return
             if author_id not in self.reviews:
@@ -148,7 +216,6 @@ class ModBot(discord.Client):
                     await message.channel.send(r)
 
             if self.reviews[author_id].is_review_complete():
-                self.mode = None
                 self.reviews.pop(author_id)
 
         else:
@@ -166,7 +233,10 @@ class ModBot(discord.Client):
         mod_channel = self.mod_channels[message.guild.id]
         # await mod_channel.send(f'Forwarded message:\n{message.author.name}: "{message.content}"')
 
-        scores = self.eval_text(message)
+        new_trace()
+        with timer('score'):
+            scores = await self.eval_text(message)
+        self.message_cache.mark_scored(message)
         sorted_scores = {
             k: v for k, v in sorted(scores.items(), key=lambda item: item[1], reverse=True)}
         
@@ -182,59 +252,112 @@ class ModBot(discord.Client):
         if scores.get("HATEFUL_MEME_SCORE", 0) > hate_meme_thresh:
             send_report = True
 
+        MESSAGES.inc(flagged=str(send_report).lower())
         if send_report:
-            Report.add_report(self, message, message.jump_url)
-            await mod_channel.send(
-                f"Message flagged by automated detection: {message.jump_url}\
+            await Report.add_report(self, message, message.jump_url)
+            with timer('mod_send'):
+                await mod_channel.send(
+                    f"Message flagged by automated detection: {message.jump_url}\
                                 ```Message: {message.content}```")
-            await mod_channel.send(self.code_format(json.dumps(sorted_scores, indent=2)))
+                score_report = self.code_format(json.dumps(sorted_scores, indent=2))
+                urls = image_urls(message)
+                if len(urls) > 1:
+                    # Numbered to match the per-image HATEFUL_MEME_SCORE[i] scores
+                    names = numbered_lines([image_name(url) for url in urls], MESSAGE_LIMIT - len(score_report) - 1)
+                    score_report = names + '\n' + score_report
+                await mod_channel.send(score_report)
 
     async def on_raw_message_edit(self, payload):
         channel = self.get_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
+        # Edits usually carry the whole message, so there is no need to fetch it again. Every channel's edits
+        # are applied, since reports and reviews read any guild message from the cache
+        if channel is None:
+            self.message_cache.remove(payload.guild_id, payload.channel_id, payload.message_id)
+        else:
+            self.message_cache.apply_edit(payload, channel, self._connection)
+        # Only edits in the "group-#" channel are scored, as for new messages
+        if channel is None or getattr(channel, 'name', None) != f'group-{self.group_num}':
+            EDITS.inc(outcome='ignored')
+            return
 
-        await self.handle_channel_message(message)
+        # A burst of edits to one message is scored once, after the last of them, unless it goes on for so
+        # long that the message would stay unscored past EDIT_MAX_DELAY_SECONDS
+        pending = self.pending_edits.pop(payload.message_id, None)
+        if pending is not None:
+            pending.cancel()
+            EDITS.inc(outcome='debounced')
+        first = self.first_edits.setdefault(payload.message_id, time.monotonic())
+        delay = max(0.0, min(EDIT_DEBOUNCE_SECONDS, first + EDIT_MAX_DELAY_SECONDS - time.monotonic()))
+        self.pending_edits[payload.message_id] = asyncio.ensure_future(
+            self.rescore_edit(channel, payload.message_id, delay))
+
+    async def rescore_edit(self, channel, message_id, delay=EDIT_DEBOUNCE_SECONDS):
+        await asyncio.sleep(delay)
+        # From here on a newer edit schedules its own task rather than cancelling this one mid-scoring
+        del self.pending_edits[message_id]
+        self.first_edits.pop(message_id, None)
+        try:
+            message = await self.message_cache.fetch(channel, message_id)
+        except discord.errors.NotFound:
+            EDITS.inc(outcome='deleted')
+            return
+        except discord.errors.HTTPException:
+            # Nobody awaits this task, so errors are logged here rather than lost
+            moderation_logger.exception('Could not fetch edited message %s', message_id)
+            EDITS.inc(outcome='failed')
+            return
 
-    def eval_text(self, message):
+        # Embeds unfurling and other edits that leave the text and attachments alone need no new scores
+        changed = self.message_cache.changed_since_scored(message)
+        if not changed:
+            EDITS.inc(outcome='unchanged')
+            return
+        # Scores for the unchanged modality come from the score cache. A text edit still re-runs the meme
+        # model on a captioned image, since the model reads the caption, but the image isn't fetched again
+        # to look it up
+        EDITS.inc(outcome='rescored', changed='+'.join(changed))
+        try:
+            await self.handle_channel_message(message)
+        except Exception:
+            moderation_logger.exception('Could not re-score edited message %s', message_id)
+            EDITS.inc(outcome='failed')
+
+    async def on_raw_message_delete(self, payload):
+        self.message_cache.remove(payload.guild_id, payload.channel_id, payload.message_id)
+
+    async def eval_text(self, message, priority=AMBIENT):
         '''
         Given a message, forwards the message to Perspective and returns a dictionary of scores.
+        Scoring runs on the pipeline's executors so the event loop only awaits the result.
         '''
-        PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
-        url = PERSPECTIVE_URL + '?key=' + self.perspective_key
-
-        corrected_message = None
-        scores = {}
-        if message.content:
-            # Decode the message if it includes unicode characters
-            decoded_message = unidecode(message.content)
-            textBlb = TextBlob(decoded_message)
-            corrected_message = str(textBlb.correct())
-            data_dict = {
-                'comment': {'text': corrected_message},
-                'languages': ['en'],
-                'requestedAttributes': {
-                    'SEVERE_TOXICITY': {}, 'PROFANITY': {},
-                    'IDENTITY_ATTACK': {}, 'THREAT': {},
-                    'TOXICITY': {}, 'FLIRTATION': {}
-                },
-                'doNotStore': True
-            }
-            response = requests.post(url, data=json.dumps(data_dict))
-            response_dict = response.json()
-
-            for attr in response_dict["attributeScores"]:
-                scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
-
-        if message.attachments:
-            image_url = message.attachments[0].url
-            hateful_meme_score = self.model.infer(image_url, corrected_message)
-            scores['HATEFUL_MEME_SCORE'] = hateful_meme_score
-        
-        return scores
+        return await self.scorer.score(message, priority)
 
     def code_format(self, text):
         return "```" + text + "```"
 
 
-client = ModBot(perspective_key)
-client.run(discord_token)
+if __name__ == '__main__':
+    # Set up logging to the console
+    logger = logging.getLogger('discord')
+    logger.setLevel(logging.DEBUG)
+    # Appended to and rotated rather than truncated, so the log of a previous run survives a restart
+    handler = logging.handlers.RotatingFileHandler(filename='discord.log', encoding='utf-8',
+                                                   maxBytes=64 * 1024 * 1024, backupCount=5)
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    logger.addHandler(handler)
+    moderation_logger.setLevel(logging.DEBUG if TRACE_STAGES else logging.INFO)
+    moderation_logger.addHandler(handler)
+
+    # There should be a file called 'token.json' inside the same folder as this file
+    token_path = 'tokens.json'
+    if not os.path.isfile(token_path):
+        raise Exception(f'{token_path} not found!')
+
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        tokens = json.load(f)
+        discord_token = tokens['discord']
+        perspective_key = tokens['perspective']
+
+    client = ModBot(perspective_key)
+    client.run(discord_token)
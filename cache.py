@@ -0,0 +1,172 @@
+import hashlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from unidecode import unidecode
+
+
+def normalize_text(text):
+    '''
+    Canonical form of a message used in cache keys: ascii-folded, lower-cased, whitespace collapsed.
+    '''
+    if not text:
+        return ''
+    return ' '.join(unidecode(text).lower().split())
+
+
+def image_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class ScoreCache:
+    '''
+    Content-addressed cache of scores. Entries are keyed by a hash of the image bytes and/or the
+    normalized text, kept in an in-memory LRU and optionally in an SQLite file that survives restarts.
+    Both tiers expire entries after `ttl` seconds and evict the oldest entries once full.
+
+    Writes to the SQLite file happen on a background thread, which commits them in batches and prunes the
+    file a few rows at a time, so `put` never waits on the disk. `get(key, disk=False)` only looks in
+    memory, for callers that read the disk tier off their event loop.
+    '''
+    PRUNE_EVERY = 1000  # puts between two size/expiry sweeps of the disk tier
+    PRUNE_BATCH = 2000  # most rows deleted by one sweep, more than PRUNE_EVERY puts can add
+    MAX_PENDING_WRITES = 10000
+
+    def __init__(self, max_entries=10000, ttl=7 * 24 * 3600, db_path=None, max_db_entries=1000000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_db_entries = max_db_entries
+        self.entries = OrderedDict()  # Map from key to (expiry time, scores)
+        self.url_digests = OrderedDict()  # Map from attachment URL to the digest of its bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.dropped_writes = 0
+
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            # With WAL, NORMAL only syncs at checkpoints; a crash can lose the last commits, not corrupt the file
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS scores '
+                            '(key TEXT PRIMARY KEY, scores TEXT NOT NULL, created_at REAL NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS scores_created_at ON scores (created_at)')
+            self.db.commit()
+            self.db_lock = threading.Lock()
+            self.writes = queue.Queue(maxsize=self.MAX_PENDING_WRITES)
+            self.writer = threading.Thread(target=self._write, name='score-cache-writer', daemon=True)
+            self.writer.start()
+
+    @staticmethod
+    def key(digest=None, text=None):
+        return hashlib.sha256(f'{digest or ""}\0{normalize_text(text)}'.encode()).hexdigest()
+
+    def get(self, key, disk=True):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, scores = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return scores
+                del self.entries[key]
+            if not disk:
+                return None
+
+        if self.db is not None:
+            with self.db_lock:
+                row = self.db.execute('SELECT scores, created_at FROM scores WHERE key = ?', (key,)).fetchone()
+            if row and row[1] + self.ttl > now:
+                scores = json.loads(row[0])
+                with self.lock:
+                    self._remember(key, scores, row[1] + self.ttl)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return scores
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, scores):
+        now = time.time()
+        with self.lock:
+            self._remember(key, scores, now + self.ttl)
+        if self.db is not None:
+            try:
+                self.writes.put_nowait((key, json.dumps(scores), now))
+            except queue.Full:
+                # The memory tier still has the entry; only its copy on disk is lost
+                self.dropped_writes += 1
+
+    def _remember(self, key, scores, expires_at):
+        self.entries[key] = (expires_at, scores)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _write(self):
+        while True:
+            rows = [self.writes.get()]
+            # Everything queued meanwhile goes into the same commit
+            while not self.writes.empty():
+                rows.append(self.writes.get_nowait())
+            if rows[-1] is None:
+                rows.pop()
+                self._commit(rows)
+                return
+            self._commit(rows)
+
+    def _commit(self, rows):
+        with self.db_lock:
+            self.db.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?)', rows)
+            before = self.puts
+            self.puts += len(rows)
+            if self.puts // self.PRUNE_EVERY > before // self.PRUNE_EVERY:
+                self._prune_db(time.time())
+            self.db.commit()
+
+    def _prune_db(self, now):
+        # At most PRUNE_BATCH rows per sweep, so no single sweep holds the database for long
+        deleted = self.db.execute('DELETE FROM scores WHERE key IN (SELECT key FROM scores WHERE created_at < ? '
+                                  'LIMIT ?)', (now - self.ttl, self.PRUNE_BATCH)).rowcount
+        excess = self.db.execute('SELECT COUNT(*) FROM scores').fetchone()[0] - self.max_db_entries
+        if excess > 0:
+            self.db.execute('DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY created_at LIMIT ?)',
+                            (min(excess, self.PRUNE_BATCH - deleted),))
+
+    def close(self):
+        # Flushes the writes still queued
+        if self.db is not None and self.writer.is_alive():
+            self.writes.put(None)
+            self.writer.join(timeout=5)
+
+    def digest_for_url(self, url):
+        with self.lock:
+            return self.url_digests.get(url)
+
+    def remember_url(self, url, digest):
+        with self.lock:
+            self.url_digests[url] = digest
+            self.url_digests.move_to_end(url)
+            while len(self.url_digests) > self.max_entries:
+                self.url_digests.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+        }
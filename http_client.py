@@ -0,0 +1,86 @@
+import asyncio
+import random
+
+import aiohttp
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+class HttpClient:
+    '''
+    Shared aiohttp session for Perspective requests and attachment downloads. Connections are pooled and
+    kept alive across messages, concurrency is capped per host, every request has a timeout, and
+    transient failures (timeouts, connection errors, 429 and 5xx responses) are retried with jittered
+    exponential backoff. No wait is longer than `max_backoff` seconds, whatever a Retry-After header asks.
+    '''
+
+    def __init__(self, limit=100, limit_per_host=16, timeout=10, retries=3, backoff=0.5, max_backoff=10,
+                 max_download_bytes=8 * 1024 * 1024):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_download_bytes = max_download_bytes
+        self.session = None
+        self.retried = 0
+
+    def _get_session(self):
+        # Created lazily so the session binds to the loop that is running the bot
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def _request(self, method, url, handle, **kwargs):
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                async with self._get_session().request(method, url, **kwargs) as response:
+                    if response.status in RETRY_STATUSES and not last_attempt:
+                        delay = self._retry_after(response) or self._delay(attempt)
+                    else:
+                        response.raise_for_status()
+                        return await handle(response)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+                delay = self._delay(attempt)
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    def _delay(self, attempt):
+        return min(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5), self.max_backoff)
+
+    def _retry_after(self, response):
+        try:
+            return min(max(float(response.headers.get('Retry-After', '')), 0.0), self.max_backoff)
+        except ValueError:
+            return None
+
+    async def post_json(self, url, payload, params=None):
+        async def handle(response):
+            return await response.json(content_type=None)
+        return await self._request('POST', url, handle, json=payload, params=params)
+
+    async def download(self, url):
+        async def handle(response):
+            if (response.content_length or 0) > self.max_download_bytes:
+                raise DownloadTooLarge(f'{url} is {response.content_length} bytes')
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data.extend(chunk)
+                if len(data) > self.max_download_bytes:
+                    raise DownloadTooLarge(f'{url} exceeds {self.max_download_bytes} bytes')
+            return bytes(data)
+        return await self._request('GET', url, handle)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import discord
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')
+
+
+def is_image(attachment):
+    content_type = getattr(attachment, 'content_type', None)
+    if content_type:
+        return content_type.startswith('image/')
+    return attachment.filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def embed_image_urls(message):
+    # Discord's media proxy copies rather than the linked URLs, so the bot never fetches a host a user picked
+    urls = []
+    for embed in message.embeds:
+        if embed.type == 'image':
+            # A bare link to an image, unfurled by Discord into a thumbnail
+            url = getattr(embed.thumbnail, 'proxy_url', None)
+        else:
+            url = getattr(embed.image, 'proxy_url', None)
+        if url:
+            urls.append(url)
+    return urls
+
+
+def image_urls(message):
+    '''
+    URLs of every image on a message without repeats: image attachments first, then embedded images.
+    '''
+    urls = [attachment.url for attachment in message.attachments if is_image(attachment)]
+    return list(dict.fromkeys(urls + embed_image_urls(message)))
+
+
+def image_name(url):
+    # File name of an image URL, which is far shorter than the URL in messages to moderators
+    return os.path.basename(urlparse(url).path) or url
+
+
+def numbered_lines(lines, limit):
+    '''
+    `lines` numbered from 1, one per line, as many as fit in `limit` characters followed by a count of the
+    ones left out. Messages and embed fields longer than Discord's limits are rejected.
+    '''
+    # Room is kept for the count whether or not it is needed
+    room = limit - len(f'\n(and {len(lines)} more)')
+    kept = []
+    length = 0
+    for i, line in enumerate(lines, 1):
+        entry = f'[{i}] {line}'
+        length += len(entry) + 1
+        if length > room:
+            kept.append(f'(and {len(lines) - i + 1} more)')
+            break
+        kept.append(entry)
+    return '\n'.join(kept)
+
+
+class MessageCache:
+    '''
+    Bounded LRU of Discord messages keyed by (guild id, channel id, message id), so a message seen on the
+    gateway is not fetched again over HTTP when it is edited, reported or reviewed. Entries expire after
+    `ttl` seconds; edits carrying the full message are applied from the gateway payload. Fingerprints of
+    each message as it was last scored tell edits that change its text or attachments from ones that don't.
+    '''
+
+    def __init__(self, max_entries=10000, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # Map from key to (expiry time, message)
+        self.fingerprints = OrderedDict()  # Map from key to the fingerprints of the message as last scored
+        self.hits = 0
+        self.misses = 0
+        self.edits_applied = 0
+
+    @staticmethod
+    def key(guild_id, channel_id, message_id):
+        return guild_id, channel_id, message_id
+
+    def put(self, message):
+        key = self.key(message.guild.id if message.guild else None, message.channel.id, message.id)
+        self.entries[key] = (time.monotonic() + self.ttl, message)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, guild_id, channel_id, message_id):
+        key = self.key(guild_id, channel_id, message_id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, message = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return message
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def remove(self, guild_id, channel_id, message_id):
+        key = self.key(guild_id, channel_id, message_id)
+        self.entries.pop(key, None)
+        self.fingerprints.pop(key, None)
+
+    @staticmethod
+    def fingerprint(message):
+        '''
+        Digests of the message's text and of its attachments and embedded images. Attachments are identified
+        by id where there is one, since their signed CDN URLs change without the file changing.
+        '''
+        text = hashlib.sha1((message.content or '').encode()).digest()
+        attachments = [str(getattr(a, 'id', None) or a.url) for a in message.attachments]
+        attachments = '\n'.join(attachments + embed_image_urls(message))
+        return {'text': text, 'attachments': hashlib.sha1(attachments.encode()).digest()}
+
+    def mark_scored(self, message):
+        key = self.key(message.guild.id if message.guild else None, message.channel.id, message.id)
+        self.fingerprints[key] = self.fingerprint(message)
+        self.fingerprints.move_to_end(key)
+        while len(self.fingerprints) > self.max_entries:
+            self.fingerprints.popitem(last=False)
+
+    def changed_since_scored(self, message):
+        '''
+        Which of 'text' and 'attachments' differ from when the message was last scored. Both, if it never was.
+        '''
+        key = self.key(message.guild.id if message.guild else None, message.channel.id, message.id)
+        scored = self.fingerprints.get(key)
+        if scored is None:
+            return ['text', 'attachments']
+        current = self.fingerprint(message)
+        return [part for part in ('text', 'attachments') if current[part] != scored[part]]
+
+    async def fetch(self, channel, message_id):
+        '''
+        The message from the cache, or fetched from Discord and cached. Raises discord.errors.NotFound like
+        `channel.fetch_message`.
+        '''
+        guild_id = channel.guild.id if getattr(channel, 'guild', None) else None
+        message = self.get(guild_id, channel.id, message_id)
+        if message is None:
+            message = await channel.fetch_message(message_id)
+            self.put(message)
+        return message
+
+    def apply_edit(self, payload, channel, state):
+        '''
+        Applies a raw MESSAGE_UPDATE without an HTTP round trip. Content edits carry the whole message and
+        replace the cached one; partial updates (such as embeds resolving) are merged into the cached
+        message. Returns None when neither is possible and the message has to be fetched.
+        '''
+        data = payload.data
+        if 'author' in data and 'content' in data:
+            message = discord.Message(state=state, channel=channel, data=data)
+            self.put(message)
+            self.edits_applied += 1
+            return message
+        guild_id = channel.guild.id if getattr(channel, 'guild', None) else None
+        message = self.get(guild_id, channel.id, payload.message_id)
+        if message is not None:
+            message._update(data)
+            self.edits_applied += 1
+        return message
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'edits_applied': self.edits_applied,
+            'entries': len(self.entries),
+        }
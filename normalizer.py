@@ -0,0 +1,157 @@
+import os
+import re
+from functools import lru_cache
+
+from unidecode import unidecode
+
+# Common character substitutions used to dodge keyword filters, e.g. "h4t3", "1d10t", "$hit"
+LEET_MAP = str.maketrans({'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b',
+                          '@': 'a', '$': 's', '|': 'l'})
+TOKEN_RE = re.compile(r"[A-Za-z0-9@$|]+|[^A-Za-z0-9@$|]+")
+REPEAT_RE = re.compile(r'(\w)\1{2,}')
+# Times, ordinals, decades and quantities ("10am", "4th", "90s", "1080p", "5k"), which are not leetspeak
+NUMBER_RE = re.compile(r'\d+(?:st|nd|rd|th|s|am|pm|[hkmpx])?', re.IGNORECASE)
+
+
+def default_dictionary_path():
+    # Same word frequencies TextBlob corrects against, so both normalizers agree on the vocabulary
+    import textblob.en
+    return os.path.join(os.path.dirname(textblob.en.__file__), 'en-spelling.txt')
+
+
+def load_frequencies(path):
+    frequencies = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith(';;;'):
+                continue
+            parts = line.split()
+            if len(parts) == 2 and parts[1].isdigit():
+                frequencies[parts[0]] = int(parts[1])
+    return frequencies
+
+
+def edit_distance(a, b, max_distance):
+    '''
+    Optimal string alignment distance (Levenshtein plus adjacent transpositions), or max_distance + 1 once
+    the distance is known to exceed max_distance.
+    '''
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class NoopNormalizer:
+    def __call__(self, text):
+        # Decode the message if it includes unicode characters
+        return unidecode(text)
+
+
+class TextBlobNormalizer:
+    '''
+    The original normalizer: Norvig-style correction of every word through TextBlob. Accurate but slow.
+    '''
+    def __call__(self, text):
+        from textblob import TextBlob
+        return str(TextBlob(unidecode(text)).correct())
+
+
+class SymSpellNormalizer:
+    '''
+    Spelling normalizer based on symmetric-delete lookup (SymSpell). Every dictionary word is indexed under
+    all strings reachable by deleting up to `max_edit_distance` characters from its prefix, so a lookup
+    only generates deletes of the query instead of all its edits. Leetspeak and stretched letters are
+    undone before lookup, and results are memoized per token.
+    '''
+
+    def __init__(self, dictionary_path=None, max_edit_distance=2, prefix_length=7, cache_size=100000):
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        self.frequencies = load_frequencies(dictionary_path or default_dictionary_path())
+        self.deletes = {}
+        for word in self.frequencies:
+            for delete in self._deletes(word[:prefix_length]):
+                self.deletes.setdefault(delete, []).append(word)
+        self.correct_word = lru_cache(maxsize=cache_size)(self._correct_word)
+
+    def _deletes(self, word):
+        deletes = {word}
+        frontier = {word}
+        for _ in range(self.max_edit_distance):
+            frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+            deletes |= frontier
+        return deletes
+
+    def _correct_word(self, word):
+        if word in self.frequencies or len(word) < 2:
+            return word
+        best, best_key = word, None
+        for delete in self._deletes(word[:self.prefix_length]):
+            for candidate in self.deletes.get(delete, ()):
+                distance = edit_distance(word, candidate, self.max_edit_distance)
+                if distance > self.max_edit_distance:
+                    continue
+                # Closest first, then most frequent, like TextBlob
+                key = (distance, -self.frequencies[candidate])
+                if best_key is None or key < best_key:
+                    best, best_key = candidate, key
+        return best
+
+    def _looks_leet(self, token):
+        # Two letters at least, so short mixes like "b4" or "m8" are left alone
+        return NUMBER_RE.fullmatch(token) is None and sum(c.isalpha() for c in token) >= 2
+
+    def _undo_leet(self, token):
+        # The substitution is only trusted when it spells a known word, possibly stretched ("h4teee");
+        # otherwise the token is left as typed rather than corrected into some other word
+        word = token.translate(LEET_MAP).lower()
+        for candidate in (REPEAT_RE.sub(r'\1\1', word), REPEAT_RE.sub(r'\1', word)):
+            if candidate in self.frequencies:
+                return candidate
+        return None
+
+    def _normalize_token(self, token):
+        if not any(c.isalpha() for c in token):
+            return token
+        if token.isalpha():
+            corrected = self.correct_word(REPEAT_RE.sub(r'\1\1', token).lower())
+        elif self._looks_leet(token):
+            corrected = self._undo_leet(token)
+            if corrected is None:
+                return token
+        else:
+            return token
+        if token.isupper() and len(token) > 1:
+            return corrected.upper()
+        if token[0].isupper():
+            return corrected.capitalize()
+        return corrected
+
+    def __call__(self, text):
+        decoded_message = unidecode(text)
+        return ''.join(
+            self._normalize_token(token) if token[0].isalnum() or token[0] in '@$|' else token
+            for token in TOKEN_RE.findall(decoded_message)
+        )
+
+
+NORMALIZERS = {
+    'none': NoopNormalizer,
+    'textblob': TextBlobNormalizer,
+    'symspell': SymSpellNormalizer,
+}
+
+
+def get_normalizer(name='symspell', **kwargs):
+    return NORMALIZERS[name](**kwargs)
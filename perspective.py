@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+PERSPECTIVE_ATTRIBUTES = ['SEVERE_TOXICITY', 'PROFANITY', 'IDENTITY_ATTACK', 'THREAT', 'TOXICITY', 'FLIRTATION']
+
+# Request priorities, lower is served first
+REPORTED = 0
+AMBIENT = 1
+
+logger = logging.getLogger('moderation')
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        # Seconds until a token is available, 0 if one is available now
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class PerspectiveScheduler:
+    '''
+    Sends Perspective requests no faster than the `qps` quota allows. Identical texts already queued or in
+    flight share a single request, user-reported messages jump ahead of ambient channel traffic, and
+    requests that would wait longer than `max_wait` seconds (or overflow `max_queue`) are dropped and
+    resolve to None so callers can fall back to model-only scoring.
+    '''
+
+    def __init__(self, http, key, url=PERSPECTIVE_URL, qps=1.0, burst=1, max_queue=200, max_wait=10.0):
+        self.http = http
+        self.key = key
+        self.url = url
+        self.bucket = TokenBucket(qps, burst)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.queue = []  # Heap of (priority, sequence number, deadline, text)
+        self.pending = {}  # Map from text to the future shared by everyone waiting on it
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.dispatcher = None
+        self.sent = 0
+        self.deduped = 0
+        self.dropped = 0
+        self.errors = 0
+
+    async def analyze(self, text, priority=AMBIENT):
+        '''
+        Returns a dictionary of attribute scores for `text`, or None if the request was dropped or failed.
+        '''
+        if text in self.pending:
+            self.deduped += 1
+            self._promote(text, priority)
+            return await asyncio.shield(self.pending[text])
+
+        self._ensure_dispatcher()
+        if len(self.queue) >= self.max_queue and not self._evict_below(priority):
+            self.dropped += 1
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self.pending[text] = future
+        heapq.heappush(self.queue, (priority, next(self.counter), time.monotonic() + self.max_wait, text))
+        self.wakeup.set()
+        return await asyncio.shield(future)
+
+    def _promote(self, text, priority):
+        # A higher-priority caller sharing a queued request lifts it to their priority and deadline, so it is
+        # neither evicted nor expired as the lower-priority request would be
+        for index, entry in enumerate(self.queue):
+            if entry[3] == text:
+                if entry[0] > priority:
+                    self.queue[index] = (priority, entry[1], max(entry[2], time.monotonic() + self.max_wait), text)
+                    heapq.heapify(self.queue)
+                return
+
+    def _evict_below(self, priority):
+        # Makes room for a new request by dropping the newest queued request of strictly lower priority
+        candidates = [entry for entry in self.queue if entry[0] > priority]
+        if not candidates:
+            return False
+        victim = max(candidates, key=lambda entry: (entry[0], entry[1]))
+        self.queue.remove(victim)
+        heapq.heapify(self.queue)
+        self._resolve(victim[3], None)
+        self.dropped += 1
+        return True
+
+    def _ensure_dispatcher(self):
+        if self.dispatcher is None or self.dispatcher.done():
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            delay = self.bucket.wait_time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, deadline, text = heapq.heappop(self.queue)
+            if time.monotonic() > deadline:
+                self.dropped += 1
+                self._resolve(text, None)
+                continue
+            self.bucket.take()
+            asyncio.ensure_future(self._send(text))
+
+    async def _send(self, text):
+        data_dict = {
+            'comment': {'text': text},
+            'languages': ['en'],
+            'requestedAttributes': {attr: {} for attr in PERSPECTIVE_ATTRIBUTES},
+            'doNotStore': True
+        }
+        scores = None
+        try:
+            self.sent += 1
+            response_dict = await self.http.post_json(self.url, data_dict, params={'key': self.key})
+            scores = {}
+            for attr in response_dict["attributeScores"]:
+                scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
+        except Exception as e:
+            # Quota errors, timeouts and malformed responses all degrade to model-only scoring
+            logger.warning('Perspective request failed: %r', e)
+            self.errors += 1
+            scores = None
+        finally:
+            self._resolve(text, scores)
+
+    def _resolve(self, text, scores):
+        future = self.pending.pop(text, None)
+        if future is not None and not future.done():
+            future.set_result(scores)
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.queue),
+            'in_flight': len(self.pending) - len(self.queue),
+            'sent': self.sent,
+            'deduped': self.deduped,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
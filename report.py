@@ -1,16 +1,13 @@
 import re
-# Source: Wrapper around dict, inspired by https://docs.python.org/3/library/queue.html#queue.PriorityQueue
-from dataclasses import dataclass, field
 from enum import Enum, auto
-from typing import Any
 
 import discord
 
+from message_cache import image_urls
+from perspective import REPORTED
+from Classification.metrics import REGISTRY, TRACE_ID, new_trace, timer
 
-@dataclass(order=True)
-class PrioritizedItem:
-    priority: int
-    item: Any = field(compare=False)
+REPORTS = REGISTRY.counter('reports_total', 'Reports filed, by source and whether the message was already pending')
 
 
 class State(Enum):
@@ -67,6 +64,7 @@ class Report:
         self.reported_message_link = None
         self.reported_message = None
         self.additional_info = None
+        self.trace_id = None
 
     async def handle_message(self, message):
         '''
@@ -76,6 +74,11 @@ class Report:
         '''
 
         self.message = message
+        # A user report spans several DMs; they all share one trace ID
+        if self.trace_id is None:
+            self.trace_id = new_trace()
+        else:
+            TRACE_ID.set(self.trace_id)
         if message.content.lower() == self.CANCEL_KEYWORD:
             self.state = State.REPORT_COMPLETE
             return ["Report cancelled."]
@@ -104,7 +107,7 @@ class Report:
                     "It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
                 self.reported_message_link = message.content
-                reported_message = await channel.fetch_message(int(m.group(3)))
+                reported_message = await self.client.message_cache.fetch(channel, int(m.group(3)))
                 self.reported_message = reported_message
                 message = reported_message
                 
@@ -137,8 +140,9 @@ class Report:
             embed.set_footer(
                 text="Example: To report the message for hate speech, type `hate` or `2`.")
 
-            if message.attachments:
-                embed.set_image(url=message.attachments[0])
+            urls = image_urls(message)
+            if urls:
+                embed.set_image(url=urls[0])
 
             self.state = State.CHOOSE_TYPE
             return [{"content": reply, "embed": embed}]
@@ -247,9 +251,10 @@ class Report:
             else:
                 return ["Unrecognised option. Please select from `skip`, `block` and "
                         "`limit content`"]
-            await self.mod_channel.send(mod_channel_msg)
+            with timer('mod_send'):
+                await self.mod_channel.send(mod_channel_msg)
 
-            Report.add_report(
+            await Report.add_report(
                 client=self.client,
                 reported_message=self.reported_message,
                 reported_message_link=self.reported_message_link,
@@ -267,43 +272,34 @@ class Report:
         return self.state == State.REPORT_COMPLETE
 
     @classmethod
-    def add_report(cls, client, reported_message, reported_message_link,
+    async def add_report(cls, client, reported_message, reported_message_link,
                    reporter=None, additional_info=None):
-
-        if reported_message_link in client.message_report_map:
-            client.message_report_map[reported_message_link]["nreports"] += 1
-            if reporter and reporter not in \
-                    client.message_report_map[reported_message_link]["Reporters"]:
-                client.message_report_map[reported_message_link]["Reporters"].append(
-                    reporter)
-            if additional_info:
-                if client.message_report_map[reported_message_link]["Additional Info"]:
-                    client.message_report_map[reported_message_link][
-                        "Additional Info"] += "\n\t" + additional_info
-                else:
-                    client.message_report_map[reported_message_link][
-                        "Additional Info"] = additional_info
-
+        reporter_id = reporter.id if reporter else None
+        source = 'user' if reporter else 'automated'
+        if client.report_store.is_pending(reported_message_link):
+            with timer('report_enqueue'):
+                client.report_store.add_repeat(reported_message_link, reporter_id, additional_info)
+            REPORTS.inc(source=source, repeat='true')
+            return
+
+        scores = await client.eval_text(reported_message, priority=REPORTED)
+        sorted_scores = [v for k, v in
+                         sorted(scores.items(), key=lambda item: item[1],
+                                reverse=True)]
+        # No scores when Perspective is over budget and the message has no attachment
+        key = sorted_scores[0] if sorted_scores else 0
+
+        # Every image is kept with its own score, so review can show them all and confirm the worst
+        urls = image_urls(reported_message)
+        if len(urls) > 1:
+            attachments = [(url, scores.get(f'HATEFUL_MEME_SCORE[{i}]')) for i, url in enumerate(urls, 1)]
         else:
-            scores = client.eval_text(reported_message)
-            sorted_scores = [v for k, v in
-                             sorted(scores.items(), key=lambda item: item[1],
-                                    reverse=True)]
-            key = sorted_scores[0]
-
-            value = {"Message": reported_message.content,
-                     "Message Link": reported_message_link,
-                     "Additional Info": additional_info,
-                     "nreports": 1}
-            if reporter:
-                value["Reporters"] = [reporter]
-            else:
-                value["Reporters"] = []
-            if reported_message.attachments:
-                value["Attachment"] = reported_message.attachments[0]
-            client.message_report_map[reported_message_link] = value
-
-            client.pending_reports.put(PrioritizedItem(-key, reported_message_link))
+            attachments = [(url, scores.get('HATEFUL_MEME_SCORE')) for url in urls]
+        with timer('report_enqueue'):
+            client.report_store.add(reported_message_link, reported_message.author.id, reported_message.content, key,
+                                    attachments=attachments, reporter_id=reporter_id,
+                                    additional_info=additional_info, trace_id=TRACE_ID.get())
+        REPORTS.inc(source=source, repeat='false')
 
     @classmethod
     def hate_cat_embed(cls):
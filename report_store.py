@@ -0,0 +1,261 @@
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import deque
+
+PENDING = 'pending'
+RESOLVED = 'resolved'
+LEASE_SECONDS = 300
+
+# Base priority = score + log(1 + number of reports) and the summed trust of the reporters, each weighted
+SCORE_WEIGHT = 1.0
+REPORTS_WEIGHT = 0.25
+TRUST_WEIGHT = 0.25
+# Priority a pending report gains per second of waiting: a full model score every 10 hours
+AGING_RATE = 0.1 / 3600
+DEFAULT_TRUST = 0.5
+
+
+def priority_key(score, nreports, trust, created_at):
+    '''
+    Time-invariant queue key: base priority minus AGING_RATE * created_at. At any instant, ordering by it
+    is the same as ordering by base + AGING_RATE * age, so reports age without their rows being rewritten
+    and only a new report of a message moves it in the index.
+    '''
+    base = SCORE_WEIGHT * score + REPORTS_WEIGHT * math.log1p(nreports) + TRUST_WEIGHT * trust
+    return base - AGING_RATE * created_at
+
+
+def reporter_trust(upheld, dismissed):
+    # Share of a reporter's reviewed reports that moderators upheld, starting from DEFAULT_TRUST
+    return (upheld + 1) / (upheld + dismissed + 2)
+
+
+class ReportStore:
+    '''
+    Durable store of user and automated reports, one row per reported message, in an SQLite file in WAL
+    mode so the moderation backlog survives restarts. The highest-priority pending report is found through
+    the (status, priority) index, reporters are kept in their own table keyed by (message link, reporter id)
+    so a duplicate report is a primary-key lookup, and nothing is loaded into memory on startup beyond the
+    pending count.
+
+    Reports are ordered by `priority_key`, which combines the model score, the number of reports, the
+    trust earned by the reporters and the time the report has waited. A repeat report updates the key of
+    that one row, so the queue never has to be rebuilt, and old low-scoring reports cannot starve.
+
+    Moderators check reports out with `claim`, which leases the highest-priority report nobody holds. The
+    lease is renewed by `heartbeat` and lapses on its own after `lease` seconds, at which point the report
+    goes back to the queue for any moderator. Only the lease holder can resolve a report.
+    '''
+
+    def __init__(self, db_path='reports.db', lease=LEASE_SECONDS, metrics_window=3600):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.lease = lease
+        self.metrics_window = metrics_window
+        self.resolved = deque()  # (resolved at, seconds the report waited) within the metrics window
+        self.expired_leases = 0
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only risks the last few commits on power loss, never corruption
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.create_function('priority_key', 4, priority_key, deterministic=True)
+        self.db.execute('CREATE TABLE IF NOT EXISTS reports ('
+                        'link TEXT PRIMARY KEY, author_id INTEGER, content TEXT, attachments TEXT, '
+                        'additional_info TEXT, nreports INTEGER NOT NULL, score REAL NOT NULL, trust REAL NOT NULL, '
+                        'priority REAL NOT NULL, status TEXT NOT NULL, created_at REAL NOT NULL, '
+                        'updated_at REAL NOT NULL, claimed_by INTEGER, lease_expires REAL, trace_id TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS reporters ('
+                        'link TEXT NOT NULL, reporter_id INTEGER NOT NULL, PRIMARY KEY (link, reporter_id)) '
+                        'WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS reporter_trust ('
+                        'reporter_id INTEGER PRIMARY KEY, upheld INTEGER NOT NULL, dismissed INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS reports_queue ON reports (status, priority DESC, created_at)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS reports_author ON reports (author_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS reports_age ON reports (status, created_at)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS reports_claimed_by ON reports (claimed_by)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS reports_lease ON reports (lease_expires)')
+        self.db.commit()
+        self.pending = self.db.execute('SELECT COUNT(*) FROM reports WHERE status = ?', (PENDING,)).fetchone()[0]
+
+    def is_pending(self, link):
+        with self.lock:
+            row = self.db.execute('SELECT status FROM reports WHERE link = ?', (link,)).fetchone()
+        return row is not None and row[0] == PENDING
+
+    def _trust(self, reporter_id):
+        if reporter_id is None:
+            return 0.0
+        row = self.db.execute('SELECT upheld, dismissed FROM reporter_trust WHERE reporter_id = ?',
+                              (reporter_id,)).fetchone()
+        return reporter_trust(*row) if row else DEFAULT_TRUST
+
+    def _insert(self, link, author_id, content, attachments, score, reporter_id, additional_info, now,
+                trace_id=None):
+        row = self.db.execute('SELECT status FROM reports WHERE link = ?', (link,)).fetchone()
+        if row is not None and row[0] == PENDING:
+            # Reported again while its first report was still being scored
+            self._repeat(link, reporter_id, additional_info, now)
+            return
+        if row is not None:
+            # A message that was resolved and is reported again starts over as a fresh report
+            self.db.execute('DELETE FROM reporters WHERE link = ?', (link,))
+        trust = self._trust(reporter_id)
+        self.db.execute('INSERT OR REPLACE INTO reports (link, author_id, content, attachments, additional_info, '
+                        'nreports, priority, status, created_at, updated_at, score, trust, trace_id) '
+                        'VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?)',
+                        (link, author_id, content, json.dumps(attachments) if attachments else None, additional_info,
+                         priority_key(score, 1, trust, now), PENDING, now, now, score, trust, trace_id))
+        if reporter_id is not None:
+            self.db.execute('INSERT INTO reporters VALUES (?, ?)', (link, reporter_id))
+        self.pending += 1
+
+    def _repeat(self, link, reporter_id, additional_info, now):
+        # Only a reporter's first report of a message adds their trust
+        trust = 0.0
+        if reporter_id is not None:
+            inserted = self.db.execute('INSERT OR IGNORE INTO reporters VALUES (?, ?)', (link, reporter_id))
+            if inserted.rowcount:
+                trust = self._trust(reporter_id)
+        self.db.execute(
+            "UPDATE reports SET nreports = nreports + 1, trust = trust + ?, "
+            "priority = priority_key(score, nreports + 1, trust + ?, created_at), updated_at = ?, "
+            "additional_info = CASE WHEN ? IS NULL THEN additional_info WHEN additional_info IS NULL THEN ? "
+            "ELSE additional_info || char(10) || char(9) || ? END WHERE link = ?",
+            (trust, trust, now, additional_info, additional_info, additional_info, link))
+
+    def add(self, link, author_id, content, score, attachments=None, reporter_id=None, additional_info=None,
+            trace_id=None):
+        '''
+        Queues a report of a message. `attachments` lists the message's images as (URL, hateful meme score)
+        pairs, the score being None where the image was not scored.
+        '''
+        with self.lock, self.db:
+            self._insert(link, author_id, content, attachments, score, reporter_id, additional_info, time.time(),
+                         trace_id)
+
+    def add_repeat(self, link, reporter_id=None, additional_info=None):
+        '''
+        Records another report of a pending message. The reporter is only listed once however often they report it.
+        '''
+        with self.lock, self.db:
+            self._repeat(link, reporter_id, additional_info, time.time())
+
+    def claim(self, moderator_id):
+        '''
+        Leases the highest-priority pending report that is not leased to another moderator and returns its
+        link, or None when there is nothing left to review. A moderator gets back a report they still hold.
+        '''
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute('SELECT link, claimed_by FROM reports WHERE claimed_by = ? AND status = ? AND '
+                                  'lease_expires >= ? LIMIT 1', (moderator_id, PENDING, now)).fetchone()
+            if row is None:
+                row = self.db.execute('SELECT link, claimed_by FROM reports WHERE status = ? AND '
+                                      '(claimed_by IS NULL OR lease_expires < ?) '
+                                      'ORDER BY priority DESC, created_at LIMIT 1', (PENDING, now)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] != moderator_id:
+                self.expired_leases += 1
+            self.db.execute('UPDATE reports SET claimed_by = ?, lease_expires = ? WHERE link = ?',
+                            (moderator_id, now + self.lease, row[0]))
+        return row[0]
+
+    def heartbeat(self, link, moderator_id):
+        '''
+        Extends the moderator's lease on `link`. False if the lease has lapsed and the report was claimed by
+        someone else or resolved in the meantime.
+        '''
+        now = time.time()
+        with self.lock, self.db:
+            updated = self.db.execute('UPDATE reports SET lease_expires = ? WHERE link = ? AND status = ? AND '
+                                      '(claimed_by = ? OR claimed_by IS NULL OR lease_expires < ?)',
+                                      (now + self.lease, link, PENDING, moderator_id, now))
+            if updated.rowcount:
+                self.db.execute('UPDATE reports SET claimed_by = ? WHERE link = ?', (moderator_id, link))
+        return updated.rowcount == 1
+
+    def release(self, link, moderator_id):
+        with self.lock, self.db:
+            self.db.execute('UPDATE reports SET claimed_by = NULL, lease_expires = NULL WHERE link = ? AND '
+                            'claimed_by = ?', (link, moderator_id))
+
+    def get(self, link):
+        '''
+        The report for `link` in the shape the review flow uses, or None. "Attachments" holds every image as a
+        [URL, score] pair and "Attachment" the URL of the highest-scoring one.
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT content, additional_info, nreports, attachments, author_id, trace_id '
+                                  'FROM reports WHERE link = ?', (link,)).fetchone()
+            if row is None:
+                return None
+            reporters = [r[0] for r in self.db.execute('SELECT reporter_id FROM reporters WHERE link = ?', (link,))]
+        report = {"Message": row[0],
+                  "Message Link": link,
+                  "Additional Info": row[1],
+                  "nreports": row[2],
+                  "Author": row[4],
+                  "Trace ID": row[5],
+                  "Reporters": reporters}
+        if row[3]:
+            report["Attachments"] = json.loads(row[3])
+            # Unscored images rank below any scored one; among equals the first wins
+            report["Attachment"] = max(report["Attachments"], key=lambda a: -1 if a[1] is None else a[1])[0]
+        return report
+
+    def resolve(self, link, moderator_id, upheld=None):
+        '''
+        Marks a report reviewed. False if the moderator no longer holds its lease. `upheld` says whether the
+        moderator agreed with the reporters, which raises or lowers their trust; None leaves it unchanged.
+        '''
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute('SELECT created_at FROM reports WHERE link = ? AND status = ? AND '
+                                  '(claimed_by = ? OR claimed_by IS NULL OR lease_expires < ?)',
+                                  (link, PENDING, moderator_id, now)).fetchone()
+            if row is None:
+                return False
+            self.db.execute('UPDATE reports SET status = ?, updated_at = ?, claimed_by = ?, lease_expires = NULL '
+                            'WHERE link = ?', (RESOLVED, now, moderator_id, link))
+            if upheld is not None:
+                column = 'upheld' if upheld else 'dismissed'
+                reporters = self.db.execute('SELECT reporter_id FROM reporters WHERE link = ?', (link,)).fetchall()
+                self.db.executemany('INSERT OR IGNORE INTO reporter_trust VALUES (?, 0, 0)', reporters)
+                self.db.executemany(f'UPDATE reporter_trust SET {column} = {column} + 1 WHERE reporter_id = ?',
+                                    reporters)
+            self.pending -= 1
+            self.resolved.append((now, now - row[0]))
+        return True
+
+    def pending_count(self):
+        return self.pending
+
+    def stats(self):
+        '''
+        Queue depth, active leases, age of the oldest pending report, and the number of reports resolved
+        and their mean time in the queue over the last `metrics_window` seconds.
+        '''
+        now = time.time()
+        with self.lock:
+            while self.resolved and self.resolved[0][0] < now - self.metrics_window:
+                self.resolved.popleft()
+            oldest = self.db.execute('SELECT MIN(created_at) FROM reports WHERE status = ?', (PENDING,)).fetchone()[0]
+            # Resolved reports have no lease, so this only counts pending ones
+            leased = self.db.execute('SELECT COUNT(*) FROM reports WHERE lease_expires >= ?', (now,)).fetchone()[0]
+            waits = [wait for _, wait in self.resolved]
+        return {
+            'pending': self.pending,
+            'leased': leased,
+            'expired_leases': self.expired_leases,
+            'oldest_pending_age_s': round(now - oldest, 1) if oldest else 0.0,
+            'resolved_in_window': len(waits),
+            'resolved_per_hour': round(len(waits) * 3600 / self.metrics_window, 1),
+            'mean_time_to_resolve_s': round(sum(waits) / len(waits), 1) if waits else 0.0,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
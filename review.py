@@ -1,9 +1,16 @@
+import logging
 import re
 from collections import defaultdict
 from enum import Enum, auto
 
 import discord
 from report import Report
+from message_cache import numbered_lines
+from Classification.metrics import REGISTRY, TRACE_ID, timer
+
+logger = logging.getLogger('moderation')
+
+REVIEWS = REGISTRY.counter('reviews_total', 'Reports resolved by moderators, by outcome')
 
 
 class State(Enum):
@@ -32,6 +39,7 @@ class Review:
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
     CONTINUE_KEYWORD = "yes"
+    STATS_KEYWORD = "queue"
 
     def __init__(self, client, mod_channel):
         self.state = State.REVIEW_START
@@ -40,6 +48,7 @@ class Review:
         self.message_under_review = None
         self.current_report = None
         self.author_id = None
+        self.moderator_id = None
         self.mod_channel = mod_channel
 
     async def handle_message(self, message):
@@ -48,17 +57,33 @@ class Review:
         prompts to offer at each of those states. You're welcome to change anything you want; this skeleton is just here to
         get you started and give you a model for working with Discord.
         '''
+        self.moderator_id = message.author.id
         if message.content.lower() == self.CANCEL_KEYWORD:
+            if self.current_report is not None:
+                self.client.report_store.release(self.current_report["Message Link"], self.moderator_id)
             self.state = State.REVIEW_COMPLETE
             return ["Review cancelled."]
 
+        # Log this review's stages under the trace of the message that was reported
+        if self.current_report is not None:
+            TRACE_ID.set(self.current_report["Trace ID"])
+
+        # Every reply renews this moderator's lease on the report; once it has lapsed the report may be
+        # with someone else
+        if self.current_report is not None and \
+                not self.client.report_store.heartbeat(self.current_report["Message Link"], self.moderator_id):
+            self.state = State.REVIEW_COMPLETE
+            return ["This review timed out and the report was handed to another moderator or resolved. "
+                    "Say `review` to pick up the next one."]
+
         if self.state == State.REVIEW_START:
 
-            if self.client.pending_reports.empty():
+            message = self.client.report_store.claim(self.moderator_id)
+            if message is None:
                 return ["No reports to review at this time. Bye!"]
 
-            message = self.client.pending_reports.queue[0].item
-            self.current_report = self.client.message_report_map[message]
+            self.current_report = self.client.report_store.get(message)
+            TRACE_ID.set(self.current_report["Trace ID"])
             # message = self.current_report["Message Link"]
             self.state = State.AWAITING_MESSAGE
 
@@ -78,7 +103,7 @@ class Review:
                 return [
                     "It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
-                message = await channel.fetch_message(int(m.group(3)))
+                message = await self.client.message_cache.fetch(channel, int(m.group(3)))
                 self.message_under_review = message
             except discord.errors.NotFound:
                 return [
@@ -91,7 +116,7 @@ class Review:
 
             reply = "Thank you for starting the reviewing process. "
             reply += "Say `help` at any time for more information.\n"
-            reply += f"Found {self.client.pending_reports.qsize()} pending reports.\n\n"
+            reply += f"Found {self.client.report_store.pending_count()} pending reports.\n\n"
             reply += f"This message was reported for violating our hate speech policies {self.current_report['nreports']} time(s):\n"
 
             if message.content == self.current_report["Message"]:
@@ -122,6 +147,11 @@ class Review:
             embed.set_footer(text="Example: To report the message for hate speech, type `hate` or `1`.")
             if "Attachment" in self.current_report:
                 embed.set_image(url=self.current_report["Attachment"])
+            attachments = self.current_report.get("Attachments", [])
+            if len(attachments) > 1:
+                lines = [url + ("" if score is None else f" (score: {score:.2f})") for url, score in attachments]
+                # Embed field values are limited to 1024 characters
+                embed.add_field(name="Attachments", value=numbered_lines(lines, 1024), inline=False)
 
             self.state = State.CHOOSE_TYPE
             return [{"content": reply, "embed": embed}]
@@ -144,14 +174,15 @@ class Review:
                         "will not be removed from our platform. The reporter will be " \
                         "notified of our decision.\nReview complete. " \
                         "Thank You!"
-                reply = self.update_pending(reply)
+                reply = self.update_pending(reply, upheld=False)
                 # self.state = State.REVIEW_COMPLETE
                 return [reply]
 
             elif message.content.lower() == "other":
                 reply = "The message will be forwarded to the appropriate team for " \
                         "further action.\nReview complete. Thank You!"
-                reply = self.update_pending(reply)
+                # Escalated to another team, which decides; reporter trust is left as it is until then
+                reply = self.update_pending(reply, upheld=None)
                 # self.state = State.REVIEW_COMPLETE
                 return [reply]
 
@@ -192,6 +223,12 @@ class Review:
 
         if self.state == State.SUBMIT_REVIEW:
             await self.message_under_review.add_reaction("🚫")
+            if "Attachment" in self.current_report:
+                # The decision is already recorded; a failed download only costs the duplicate index an entry
+                try:
+                    await self.client.scorer.confirm_hateful(self.current_report["Attachment"])
+                except Exception:
+                    logger.exception('Could not add %s to the duplicate index', self.current_report["Attachment"])
             orig_message_author = self.message_under_review.author.name
 
             if report_counters[self.author_id] == 1:
@@ -242,26 +279,30 @@ class Review:
                                     "violations.." \
                                     % (self.current_report['Message Link'],
                                        orig_message_author)
-            await self.mod_channel.send(reply)
+            with timer('mod_send'):
+                await self.mod_channel.send(reply)
             await self.message_under_review.author.send(reply_to_author)
-            for reporter in self.current_report["Reporters"]:
+            for reporter_id in self.current_report["Reporters"]:
+                reporter = self.client.get_user(reporter_id) or await self.client.fetch_user(reporter_id)
                 await reporter.send(reply_to_reporter)
 
             reply += "\n\nReview Complete."
-            reply = self.update_pending(reply)
+            reply = self.update_pending(reply, upheld=True)
 
             return [reply]
 
         return []
 
-    def update_pending(self, reply):
-        # Remove this message from the queue and the message-report map
-        curr_message_link = self.client.pending_reports.get()
-        self.client.message_report_map.pop(curr_message_link.item)
+    def update_pending(self, reply, upheld=None):
+        # Mark the report under review as resolved; whether it was upheld feeds back into reporter trust
+        if not self.client.report_store.resolve(self.current_report["Message Link"], self.moderator_id, upheld):
+            reply += "\n\nThis review timed out and another moderator has since taken the report."
+        else:
+            REVIEWS.inc(outcome={True: 'upheld', False: 'dismissed', None: 'escalated'}[upheld])
 
-        if not self.client.pending_reports.empty():
+        if self.client.report_store.pending_count():
             reply += f"\n\nDo you wish to continue reviewing the remaning" \
-                     f" {self.client.pending_reports.qsize()} reports?" \
+                     f" {self.client.report_store.pending_count()} reports?" \
                      "\nEnter `yes` to continue."
             self.state = State.AWAIT_NEXT_ACTION
         else:
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import ScoreCache, image_digest
+from http_client import HttpClient
+from message_cache import image_urls
+from normalizer import SymSpellNormalizer
+from perspective import AMBIENT, PERSPECTIVE_URL, PerspectiveScheduler
+from Classification.metrics import in_context, timer
+
+logger = logging.getLogger('moderation')
+
+
+class ScoringPipeline:
+    '''
+    Scores messages off the Discord event loop. Perspective requests go through a rate-limited scheduler
+    and, like attachment downloads, a pooled async HTTP client. Text normalization runs on a thread pool and
+    meme inference on a separate executor so a slow forward pass never holds up text scoring. At most
+    `max_in_flight` messages are scored at once; further callers wait for a free slot. Results are cached by
+    content, so reposted texts and memes skip the work entirely.
+    '''
+
+    def __init__(self, model, perspective_key, max_in_flight=8, text_workers=4, image_workers=1, cache=None,
+                 http=None, perspective_url=PERSPECTIVE_URL, perspective_qps=1.0, normalizer=None):
+        self.model = model
+        self.cache = cache if cache is not None else ScoreCache()
+        self.http = http if http is not None else HttpClient()
+        self.perspective = PerspectiveScheduler(self.http, perspective_key, url=perspective_url, qps=perspective_qps)
+        self.text_executor = ThreadPoolExecutor(max_workers=text_workers, thread_name_prefix='text-scoring')
+        self.image_executor = ThreadPoolExecutor(max_workers=image_workers, thread_name_prefix='image-scoring')
+        if normalizer is None:
+            # Loading the dictionary takes over a second, so it happens on the text executor rather than here;
+            # texts scored before it is ready wait for it there
+            self.normalizer = self.text_executor.submit(SymSpellNormalizer)
+        else:
+            self.normalizer = Future()
+            self.normalizer.set_result(normalizer)
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.waiting = 0
+        self.in_flight = 0
+
+    async def score(self, message, priority=AMBIENT):
+        '''
+        Given a message, returns a dictionary of Perspective scores plus the hateful meme score if the
+        message has images. With several images HATEFUL_MEME_SCORE is the highest of them and each image's
+        own score is under HATEFUL_MEME_SCORE[i], numbered from 1 in the order of `image_urls`. Perspective
+        scores are left out when the quota is exhausted, and an image's score when it could not be fetched or
+        read.
+        '''
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await self._score(message, priority)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    async def _score(self, message, priority):
+        jobs = []
+        text_job = None
+        if message.content:
+            text_job = asyncio.ensure_future(self._score_text(message.content, priority))
+            jobs.append(text_job)
+        # The model is None until it has finished loading in the background
+        urls = image_urls(message) if self.model is not None else []
+        if urls:
+            jobs.append(self._score_images(urls, message.content, text_job))
+
+        scores = {}
+        for result in await asyncio.gather(*jobs):
+            scores.update(result)
+        scores.pop('CORRECTED_TEXT', None)
+        return scores
+
+    async def _score_text(self, text, priority):
+        loop = asyncio.get_running_loop()
+        key = self.cache.key(text=text)
+        scores = await self._cached(key)
+        if scores is None:
+            with timer('normalize'):
+                corrected_message = await loop.run_in_executor(self.text_executor, in_context(self.normalize, text))
+            with timer('perspective'):
+                scores = await self.perspective.analyze(corrected_message, priority)
+            if scores is None:
+                # Over the Perspective budget: the meme model still gets the corrected text
+                return {'CORRECTED_TEXT': corrected_message}
+            # The corrected text is kept alongside the scores since the meme model consumes it too
+            scores['CORRECTED_TEXT'] = corrected_message
+            self.cache.put(key, scores)
+        return dict(scores)
+
+    def normalize(self, text):
+        return self.normalizer.result()(text)
+
+    async def _cached(self, key):
+        # Memory hits are answered inline; only misses go on to the disk tier, on the text executor
+        scores = self.cache.get(key, disk=False)
+        if scores is None and self.cache.db is not None:
+            scores = await asyncio.get_running_loop().run_in_executor(self.text_executor, self.cache.get, key)
+        return scores
+
+    async def _download(self, image_url):
+        # None when the image cannot be fetched, so one bad URL leaves the rest of the message scored
+        try:
+            with timer('download'):
+                return await self.http.download(image_url)
+        except Exception as e:
+            logger.warning('Could not download %s: %r', image_url, e)
+            return None
+
+    async def _score_images(self, image_urls, text, text_job):
+        loop = asyncio.get_running_loop()
+        # Images seen before are looked up by the digest remembered for their URL; the rest are fetched at once
+        digests = {url: self.cache.digest_for_url(url) for url in image_urls}
+        unknown = [url for url, digest in digests.items() if digest is None]
+        images = dict(zip(unknown, await asyncio.gather(*map(self._download, unknown))))
+        for url in unknown:
+            if images[url] is not None:
+                digests[url] = image_digest(images[url])
+                self.cache.remember_url(url, digests[url])
+
+        # Images that could not be fetched have no key and stay unscored
+        keys = [self.cache.key(digests[url], text) if digests[url] is not None else None for url in image_urls]
+        probs = []
+        for key in keys:
+            cached = await self._cached(key) if key is not None else None
+            probs.append(cached['HATEFUL_MEME_SCORE'] if cached is not None else None)
+
+        todo = [i for i, prob in enumerate(probs) if prob is None and keys[i] is not None]
+        if todo:
+            corrected_message = None
+            if text_job is not None:
+                corrected_message = (await text_job)['CORRECTED_TEXT']
+            refetch = [image_urls[i] for i in todo if image_urls[i] not in images]
+            images.update(zip(refetch, await asyncio.gather(*map(self._download, refetch))))
+            todo = [i for i in todo if images[image_urls[i]] is not None]
+        if todo:
+            # Every uncached image goes through the model in one batch, so several cost about as much as one
+            batch = [images[image_urls[i]] for i in todo]
+            results = await loop.run_in_executor(self.image_executor,
+                                                 in_context(self.model.infer_batch, batch, corrected_message))
+            for i, prob in zip(todo, results):
+                # None for an image the model could not read, which is not cached so a later repost is retried
+                if prob is not None:
+                    probs[i] = prob
+                    self.cache.put(keys[i], {'HATEFUL_MEME_SCORE': prob})
+
+        scored = [prob for prob in probs if prob is not None]
+        if not scored:
+            return {}
+        scores = {'HATEFUL_MEME_SCORE': max(scored)}
+        if len(probs) > 1:
+            for i, prob in enumerate(probs, 1):
+                if prob is not None:
+                    scores[f'HATEFUL_MEME_SCORE[{i}]'] = prob
+        return scores
+
+    async def confirm_hateful(self, image_url):
+        '''
+        Adds a moderator-confirmed hateful meme to the model's near-duplicate index.
+        '''
+        if self.model is None:
+            return
+        loop = asyncio.get_running_loop()
+        image_bytes = await self.http.download(image_url)
+        await loop.run_in_executor(self.text_executor, self.model.confirm, image_bytes)
+
+    async def close(self):
+        await self.http.close()
+        self.cache.close()
+        self.text_executor.shutdown(wait=False)
+        self.image_executor.shutdown(wait=False)
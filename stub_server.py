@@ -0,0 +1,80 @@
+'''
+Local stand-in for Perspective and the Discord CDN, for exercising the bot's scoring path offline.
+
+    python stub_server.py --port 8089 --latency-ms 50 --failure-rate 0.1
+
+Perspective:  POST http://localhost:8089/v1alpha1/comments:analyze
+Attachments:  GET  http://localhost:8089/attachments/<name>.png
+'''
+import argparse
+import asyncio
+import hashlib
+import io
+import random
+
+from aiohttp import web
+from PIL import Image
+
+# Words that push the stub's toxicity scores up, so flagged and benign traffic can both be produced
+TOXIC_WORDS = {'hate', 'kill', 'stupid', 'idiot', 'fuck', 'die', 'ugly'}
+
+
+def fake_scores(text, attributes):
+    words = text.lower().split()
+    toxic = sum(word.strip('.,!?') in TOXIC_WORDS for word in words)
+    base = min(0.99, 0.05 + 0.3 * toxic)
+    return {
+        attr: {'summaryScore': {'value': base, 'type': 'PROBABILITY'}}
+        for attr in attributes
+    }
+
+
+def fake_image(name, size=(320, 320)):
+    # Deterministic per name, so the same URL always serves the same bytes
+    seed = int(hashlib.sha256(name.encode()).hexdigest(), 16)
+    color = (seed & 255, (seed >> 8) & 255, (seed >> 16) & 255)
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_app(latency_ms=0, failure_rate=0.0):
+    stats = {'perspective': 0, 'attachments': 0, 'failures': 0}
+
+    async def maybe_fail():
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        if random.random() < failure_rate:
+            stats['failures'] += 1
+            raise web.HTTPTooManyRequests(headers={'Retry-After': '0.05'})
+
+    async def analyze(request):
+        await maybe_fail()
+        stats['perspective'] += 1
+        body = await request.json()
+        attributes = body.get('requestedAttributes', {}).keys()
+        return web.json_response({'attributeScores': fake_scores(body['comment']['text'], attributes)})
+
+    async def attachment(request):
+        await maybe_fail()
+        stats['attachments'] += 1
+        return web.Response(body=fake_image(request.match_info['name']), content_type='image/png')
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app['stats'] = stats
+    app.router.add_post('/v1alpha1/comments:analyze', analyze)
+    app.router.add_get('/attachments/{name}', attachment)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=int, default=0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency_ms, args.failure_rate), host='127.0.0.1', port=args.port)
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from normalizer import SymSpellNormalizer  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def normalize():
+    return SymSpellNormalizer()
+
+
+@pytest.mark.parametrize('text', [
+    'meet at 10am',
+    'see you at 7pm tomorrow',
+    'the 4th of july',
+    '1st 2nd 3rd 21st',
+    'there were 100 of them, maybe 1,000',
+    'call 555 0100',
+])
+def test_times_ordinals_and_numbers_are_kept(normalize, text):
+    assert normalize(text) == text
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('I h4te you', 'I hate you'),
+    ('h4teee', 'hate'),
+    ('H4TE', 'HATE'),
+    ('$hit', 'shit'),
+    ('you 1d10t', 'you idiot'),
+])
+def test_leetspeak_is_undone(normalize, text, expected):
+    assert normalize(text) == expected
+
+
+def test_leetspeak_that_spells_no_word_is_left_as_typed(normalize):
+    assert normalize('u r so st00pid') == 'u r so st00pid'
+
+
+def test_misspellings_are_corrected(normalize):
+    assert normalize('Dont forget the meeting tommorow') == 'Dont forget the meeting tomorrow'